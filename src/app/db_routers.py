@@ -0,0 +1,93 @@
+"""
+Database routers of the gallery_api project.
+
+Read-only requests can be served from the read replicas listed in the
+`DATABASE_REPLICAS` setting, all the writes go to the primary (`default`)
+database. Reads are sent to replicas only within `replica_reads` views,
+because replicas can lag behind the primary and the requests, which write,
+should read their own writes.
+"""
+
+import contextvars
+import random
+from functools import wraps
+from django.conf import settings
+from django.http import FileResponse
+
+
+_use_replicas = contextvars.ContextVar('use_replicas', default=False)
+
+
+def use_replicas():
+    """
+    Returns `True`, when the reads should be sent to the replicas.
+    """
+    return _use_replicas.get()
+
+
+def _iterate_with_replicas(content):
+    """
+    Iterates streaming `content` with the reads sent to the replicas. Each
+    chunk can be read in a different thread, so replicas are enabled for the
+    each chunk separately.
+    """
+    iterator = iter(content)
+    while True:
+        token = _use_replicas.set(True)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _use_replicas.reset(token)
+        yield chunk
+
+
+def replica_reads(view):
+    """
+    Decorator of the view, which sends the database reads of its `GET` and
+    `HEAD` requests to the replicas, including the reads of the streamed
+    response. File responses are left untouched, so they can be sent with
+    `wsgi.file_wrapper`.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        token = _use_replicas.set(True)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _use_replicas.reset(token)
+
+        if (getattr(response, 'streaming', False)
+                and not isinstance(response, FileResponse)):
+            response.streaming_content = _iterate_with_replicas(
+                response.streaming_content)
+        return response
+
+    return wrapper
+
+
+class ReplicaRouter:
+    """
+    Sends reads of the `replica_reads` views to random replica from the
+    `DATABASE_REPLICAS` setting and the other queries to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if replicas and use_replicas():
+            return random.choice(replicas)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in getattr(settings, 'DATABASE_REPLICAS', [])
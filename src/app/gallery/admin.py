@@ -2,7 +2,7 @@
 import logging
 from django.contrib import admin
 from .forms import ImageForm
-from .models import Gallery, Image
+from .models import Gallery, Image, Thumbnail
 
 
 logger = logging.getLogger(__name__)
@@ -28,5 +28,16 @@ class ImageAdmin(admin.ModelAdmin):
     list_display = ['gallery', 'name', 'path', 'modified']
 
 
+class ThumbnailAdmin(admin.ModelAdmin):
+    """
+    Admin class for the thumbnail model.
+    """
+    list_display = ['name', 'width', 'height', 'format', 'bytes',
+                    'last_accessed']
+    list_filter = ['format']
+    readonly_fields = ['created']
+
+
 admin.site.register(Gallery, GalleryAdmin)
 admin.site.register(Image, ImageAdmin)
+admin.site.register(Thumbnail, ThumbnailAdmin)
@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .. import settings as app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """
+    Facebook Graph API is not called, because it failed too many times.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the calls of external service.
+
+    After `threshold` consecutive failures, the circuit is open and calls are
+    refused for `reset_timeout` seconds. Then the calls are allowed again, but
+    the first failure opens the circuit again, until some call succeeds.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns `True`, when the call is allowed.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half-open, next failure opens the circuit again
+                self.opened_at = None
+                self.failures = self.threshold - 1
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(app_settings.FACEBOOK_GRAPH_BREAKER_THRESHOLD,
+                         app_settings.FACEBOOK_GRAPH_BREAKER_RESET_TIMEOUT)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns HTTP session shared by all the threads. It keeps connections to
+    Facebook Graph API alive and retries failed requests with backoff.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=app_settings.FACEBOOK_GRAPH_RETRIES,
+                backoff_factor=app_settings.FACEBOOK_GRAPH_RETRY_BACKOFF,
+                status_forcelist=[500, 502, 503, 504],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_maxsize=app_settings.FACEBOOK_GRAPH_POOL_SIZE,
+                max_retries=retry,
+            )
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+    return _session
+
+
+def get(url, **kwargs):
+    """
+    Sends `GET` request to Facebook Graph API through the shared session with
+    the configured timeouts. Raises `CircuitOpen`, when the API failed too
+    many times recently, or `requests.RequestException`.
+
+    Server errors and failed connections are counted as failures of the API.
+    """
+    if not breaker.allow():
+        raise CircuitOpen('Facebook Graph API is unavailable.')
+
+    kwargs.setdefault('timeout', (app_settings.FACEBOOK_GRAPH_CONNECT_TIMEOUT,
+                                  app_settings.FACEBOOK_GRAPH_READ_TIMEOUT))
+    try:
+        response = get_session().get(url, **kwargs)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    return response
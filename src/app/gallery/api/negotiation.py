@@ -0,0 +1,28 @@
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+class ImageContentNegotiation(DefaultContentNegotiation):
+    """
+    Content negotiation of the image views. Images are not rendered by
+    renderers, so `Accept` header with image media types only (e.g.
+    'image/webp') does not end with `406 Not Acceptable`. The first renderer
+    is used for the error responses instead.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return renderers[0], renderers[0].media_type
+
+
+def content_negotiation_class(negotiation_class):
+    """
+    Sets content negotiation class of the view created with `api_view`
+    decorator, which does not support it.
+    """
+    def decorator(view):
+        view.cls.content_negotiation_class = negotiation_class
+        return view
+    return decorator
@@ -0,0 +1,15 @@
+from rest_framework.pagination import CursorPagination
+from .. import settings as app_settings
+
+
+class GalleryCursorPagination(CursorPagination):
+    """
+    Opt-in keyset pagination for gallery and image lists. Pagination is
+    enabled only with `limit` query parameter, without it all the items are
+    returned. Items are ordered by creation time and position is encoded in
+    opaque `cursor` query parameter.
+    """
+    page_size = None
+    page_size_query_param = 'limit'
+    max_page_size = app_settings.PAGINATION_MAX_LIMIT
+    ordering = ('created', 'pk')
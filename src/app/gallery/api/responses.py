@@ -0,0 +1,278 @@
+import hashlib
+import logging
+import mimetypes
+import re
+import uuid
+from urllib.parse import quote
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers
+)
+from django.utils.http import http_date, parse_http_date_safe
+from .. import settings as app_settings
+from ..models import storage
+from ..rendering import OUTPUT_FORMATS, get_output_formats
+
+
+logger = logging.getLogger(__name__)
+
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# more ranges in one request are served as the whole file
+MAX_RANGES = 16
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_image_etag(image, file_size, *variant):
+    """
+    Returns strong ETag of the image file. It is derived from the image
+    identity, its `modified` timestamp and `file_size` of the original. For
+    thumbnails, `variant` is their size (`x_size`, `y_size`).
+    """
+    parts = [image.pk, image.modified.timestamp(), file_size] + list(variant)
+    digest = hashlib.md5('-'.join(str(part) for part in parts).encode())
+    return '"{}"'.format(digest.hexdigest())
+
+
+def get_not_modified_response(request, etag, modified):
+    """
+    Evaluates `If-None-Match` and `If-Modified-Since` (and their `If-Match`
+    and `If-Unmodified-Since` counterparts) request headers. Returns `304 Not
+    Modified` (or `412 Precondition Failed`) response or `None`, when the file
+    should be sent.
+    """
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(modified.timestamp()),
+    )
+    if response is not None:
+        set_validators(response, etag, modified)
+    return response
+
+
+def set_validators(response, etag, modified, cache_control=None, vary=None):
+    """
+    Sets `ETag`, `Last-Modified` and optionally `Cache-Control` and `Vary`
+    headers (`cache_control` is dictionary of `Cache-Control` directives,
+    `vary` is list of request headers).
+    """
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified.timestamp())
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    if vary:
+        patch_vary_headers(response, vary)
+    return response
+
+
+def get_accepted_format(request, name):
+    """
+    Returns the first of the output formats (`THUMBNAIL_FORMATS`), which is
+    accepted by the client according to the `Accept` header. Returns `None`,
+    when thumbnail should have the format of the original image with the
+    `name`. Wildcard media ranges (e.g. 'image/*') do not count, only the
+    explicitly accepted formats are sent.
+    """
+    accepted = set()
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.lower())
+
+    original_type = mimetypes.guess_type(name)[0]
+    for image_format in get_output_formats():
+        media_type = OUTPUT_FORMATS[image_format][0]
+        if media_type == original_type:
+            return None
+        if media_type in accepted:
+            return image_format
+
+    return None
+
+
+def parse_range_header(header, file_size):
+    """
+    Parses `Range` header for the file of `file_size` bytes. Returns list of
+    `(start, end)` tuples (`end` is inclusive), empty list when none of the
+    ranges is satisfiable, or `None` when the header should be ignored (it is
+    malformed, it has overlapping or too many ranges).
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+
+    ranges = []
+    for byte_range in header[len('bytes='):].split(','):
+        match = RANGE_RE.match(byte_range)
+        if not match or match.groups() == ('', ''):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            # suffix range, last N bytes, none of them in the empty file
+            if int(last) == 0 or file_size == 0:
+                continue
+            start, end = max(file_size - int(last), 0), file_size - 1
+        else:
+            start = int(first)
+            end = min(int(last), file_size - 1) if last else file_size - 1
+            if last and int(last) < start:
+                return None
+            if start >= file_size:
+                continue
+
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    ordered = sorted(ranges)
+    for (_, previous_end), (start, _) in zip(ordered, ordered[1:]):
+        if start <= previous_end:
+            return None
+
+    return ranges
+
+
+def if_range_matches(request, etag, modified):
+    """
+    Returns `True` when the `Range` header should be evaluated according to
+    `If-Range` header (it is missing or it matches the current file).
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+
+    if if_range.startswith('"'):
+        return if_range == etag
+
+    return parse_http_date_safe(if_range) == int(modified.timestamp())
+
+
+def iterate_file_range(file, start, length):
+    """
+    Generator of `length` bytes of the `file` from `start` offset.
+    """
+    file.seek(start)
+    while length > 0:
+        chunk = file.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+def get_offload_response(name, content_type):
+    """
+    Returns empty response, which instructs front web server to send the
+    file with storage `name` (`X-Accel-Redirect` for nginx, `X-Sendfile` for
+    Apache or lighttpd).
+    """
+    backend = app_settings.IMAGE_DELIVERY_BACKEND
+    response = HttpResponse(content_type=content_type)
+
+    if backend == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = quote('{}{}'.format(
+            app_settings.IMAGE_DELIVERY_ACCEL_PREFIX, name))
+    elif backend == 'x-sendfile':
+        response['X-Sendfile'] = storage.path(name)
+    else:
+        raise ImproperlyConfigured(
+            'Unknown IMAGE_DELIVERY_BACKEND: {}'.format(backend))
+
+    return response
+
+
+def get_file_response(request, name, etag, modified, file_size=None):
+    """
+    Returns response with the file with storage `name`.
+
+    With 'direct' `IMAGE_DELIVERY_BACKEND`, file is sent by Django and
+    `Range` requests are supported. For one range, response is `206 Partial
+    Content` with the range. For several ranges, it is `multipart/byteranges`
+    response. Ranges are read from the file and streamed, file is not read
+    whole into the memory.
+
+    With the other backends, transfer of the file (including ranges) is
+    offloaded to the front web server.
+    """
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    if app_settings.IMAGE_DELIVERY_BACKEND != 'direct':
+        return get_offload_response(name, content_type)
+
+    if file_size is None:
+        file_size = storage.size(name)
+
+    file = storage.open(name)
+
+    ranges = None
+    if if_range_matches(request, etag, modified):
+        ranges = parse_range_header(request.META.get('HTTP_RANGE'), file_size)
+
+    if ranges is None:
+        response = FileResponse(file, content_type=content_type)
+
+    elif not ranges:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(file_size)
+
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = FileResponse(
+            iterate_file_range(file, start, end - start + 1),
+            status=206,
+            content_type=content_type,
+        )
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end,
+                                                            file_size)
+        response['Content-Length'] = end - start + 1
+
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, end in ranges:
+            header = ('--{boundary}\r\n'
+                      'Content-Type: {content_type}\r\n'
+                      'Content-Range: bytes {start}-{end}/{size}\r\n'
+                      '\r\n').format(boundary=boundary,
+                                      content_type=content_type,
+                                      start=start, end=end, size=file_size)
+            parts.append((header.encode('ascii'), start, end))
+        closing = '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+
+        def iterate_parts():
+            for i, (header, start, end) in enumerate(parts):
+                yield (b'\r\n' if i else b'') + header
+                yield from iterate_file_range(file, start, end - start + 1)
+            yield closing
+
+        response = FileResponse(
+            iterate_parts(),
+            status=206,
+            content_type='multipart/byteranges; boundary={}'.format(boundary),
+        )
+        response['Content-Length'] = (
+            sum(len(header) + end - start + 1 for header, start, end in parts)
+            + 2 * (len(parts) - 1) + len(closing)
+        )
+
+    # file is closed with the response, `FileResponse` of the ranges has only
+    # their generator
+    if getattr(response, 'file_to_stream', None) is None:
+        response._closable_objects.append(file)
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
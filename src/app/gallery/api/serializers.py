@@ -1,5 +1,8 @@
 import logging
+from django.utils.translation import gettext as _
+from PIL import Image as PILImage
 from rest_framework import serializers
+from .. import settings as app_settings
 from ..models import Gallery, Image
 
 
@@ -16,9 +19,40 @@ class ImageSerializer(serializers.ModelSerializer):
 
 
 class ImageUploadSerializer(serializers.ModelSerializer):
+    """
+    REST API serializer for the uploaded image.
+
+    Image file is validated only with its header, which is enough to
+    recognize image format and its dimensions. Image is not decoded and the
+    dimensions are not read from the file again, when it is stored (see
+    `Image.store_file`).
+
+    Gallery of the image is not part of the validation, it is assigned by
+    the uploader.
+    """
+    file = serializers.FileField(max_length=1024)
+
     class Meta:
         model = Image
-        fields = ['gallery', 'path', 'fullpath', 'name', 'file']
+        fields = ['path', 'fullpath', 'name', 'file']
+        read_only_fields = ['fullpath']
+
+    def validate(self, data):
+        file = data['file']
+        try:
+            # Pillow reads only the header of the image here
+            with PILImage.open(file) as image:
+                data['width'], data['height'] = image.size
+        except Exception as e:
+            logger.debug(e)
+            raise serializers.ValidationError({'file': _(
+                'Upload a valid image. The file you uploaded was either not '
+                'an image or a corrupted image.'
+            )})
+        finally:
+            file.seek(0)
+
+        return data
 
 
 class GallerySerializer(serializers.ModelSerializer):
@@ -33,7 +67,20 @@ class GallerySerializer(serializers.ModelSerializer):
 
     def get_image(self, obj):
         result = None
-        image = obj.image_set.all().first()
+
+        # preview annotated by `Gallery.objects.with_preview()`
+        if hasattr(obj, 'preview_pk'):
+            image = None
+            if obj.preview_pk is not None:
+                image = {
+                    'path': obj.preview_path,
+                    'fullpath': obj.preview_fullpath,
+                    'name': obj.preview_name,
+                    'modified': obj.preview_modified,
+                }
+        else:
+            image = obj.image_set.all().first()
+
         if image:
             serializer = ImageSerializer(image)
             result = serializer.data
@@ -64,12 +111,21 @@ class GalleryDetailSerializer(serializers.ModelSerializer):
         fields = ['path', 'name', 'images']
 
     def get_images(self, obj):
-        image = obj.image_set.all()
+        # page of images, when the images are paginated
+        if 'images' in self.context:
+            image = self.context['images']
+        else:
+            image = obj.image_set.all()
         serializer = ImageSerializer(image, many=True)
         return serializer.data
 
 
 class ImagePreviewSerializer(serializers.Serializer):
+    """
+    Validates size of the thumbnail according to `THUMBNAIL_MAX_SIZE` and
+    `THUMBNAIL_SIZE_POLICY`. With 'snap' and 'redirect' policies, validated
+    size is the nearest of `THUMBNAIL_SIZES`.
+    """
     x_size = serializers.IntegerField(min_value=0)
     y_size = serializers.IntegerField(min_value=0)
 
@@ -78,4 +134,39 @@ class ImagePreviewSerializer(serializers.Serializer):
         if data['x_size'] + data['y_size'] == 0:
             raise serializers.ValidationError('Both sizes can\'t be zero!')
 
+        max_size = app_settings.THUMBNAIL_MAX_SIZE
+        if max_size and max(data['x_size'], data['y_size']) > max_size:
+            raise serializers.ValidationError(
+                'Size can\'t be bigger than {}!'.format(max_size))
+
+        policy = app_settings.THUMBNAIL_SIZE_POLICY
+        if policy == 'any':
+            return data
+
+        size = (data['x_size'], data['y_size'])
+        sizes = [tuple(allowed) for allowed in app_settings.THUMBNAIL_SIZES]
+
+        if policy == 'allowlist':
+            if size not in sizes:
+                raise serializers.ValidationError('Size is not allowed!')
+            return data
+
+        data['x_size'], data['y_size'] = self.get_nearest_size(size, sizes)
         return data
+
+    @staticmethod
+    def get_nearest_size(size, sizes):
+        """
+        Returns the nearest size from `sizes` to the `size`. Only sizes with
+        the same zero (calculated) dimension are considered.
+        """
+        candidates = [
+            allowed for allowed in sizes
+            if (allowed[0] == 0) == (size[0] == 0)
+            and (allowed[1] == 0) == (size[1] == 0)
+        ]
+        if not candidates:
+            raise serializers.ValidationError('Size is not allowed!')
+
+        return min(candidates, key=lambda allowed: (
+            abs(allowed[0] - size[0]) + abs(allowed[1] - size[1])))
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import requests
 from django.db import models
@@ -10,12 +11,39 @@ from rest_framework import exceptions
 from rest_framework.permissions import BasePermission
 from requests_oauthlib import OAuth2Session
 from .. import settings as app_settings
+from ..cache import get_cache
+from . import graph
+from .exceptions import ServiceUnavailable
 
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
 
+def get_token_cache():
+    """
+    Returns cache for the results of Facebook token verification.
+    """
+    return get_cache(app_settings.FACEBOOK_TOKEN_CACHE, 'facebook-tokens')
+
+
+def get_token_cache_key(key):
+    """
+    Returns cache key for the Facebook token `key`. Tokens are not stored in
+    the cache, only their hashes.
+    """
+    return 'gallery:facebook-token:{}'.format(
+        hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def invalidate_token(key):
+    """
+    Removes cached verification result of the Facebook token `key`, so it
+    will be verified against Facebook Graph API with the next request.
+    """
+    get_token_cache().delete(get_token_cache_key(key))
+
+
 class FacebookUser(User):
     """Model represents Facebook user.
 
@@ -29,6 +57,13 @@ class FacebookUser(User):
         abstract = True
 
 
+class InvalidFacebookToken(exceptions.AuthenticationFailed):
+    """
+    Facebook Graph API refused the token.
+    """
+    pass
+
+
 class SimpleFacebookAuthentication(TokenAuthentication):
     """
     Authentication method for REST entrypoints with Facebook Access Token.
@@ -38,6 +73,10 @@ class SimpleFacebookAuthentication(TokenAuthentication):
 
     Token must be send as `Bearer` token in `Authorization` header of HTTP
     request.
+
+    Results of the token verification are cached for
+    `FACEBOOK_TOKEN_CACHE_TTL` seconds, refused tokens for
+    `FACEBOOK_TOKEN_CACHE_NEGATIVE_TTL` seconds.
     """
 
     keyword = 'Bearer'
@@ -49,6 +88,37 @@ class SimpleFacebookAuthentication(TokenAuthentication):
             return super(SimpleFacebookAuthentication, self).authenticate(request)
 
     def authenticate_credentials(self, key):
+        cache = get_token_cache()
+        cache_key = get_token_cache_key(key)
+
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if 'error' in cached:
+                raise InvalidFacebookToken(detail=cached['error'])
+            user = FacebookUser(fb_name=cached['name'], fb_id=cached['id'])
+            return (user, key)
+
+        try:
+            user, key = self.verify_credentials(key)
+        except InvalidFacebookToken as e:
+            error = e.detail
+            if isinstance(error, dict):
+                error = {name: str(value) for name, value in error.items()}
+            else:
+                error = str(error)
+
+            cache.set(cache_key, {'error': error},
+                      app_settings.FACEBOOK_TOKEN_CACHE_NEGATIVE_TTL)
+            raise
+
+        cache.set(cache_key, {'id': user.fb_id, 'name': user.fb_name},
+                  app_settings.FACEBOOK_TOKEN_CACHE_TTL)
+        return (user, key)
+
+    def verify_credentials(self, key):
+        """
+        Verifies the token `key` against Facebook Graph API.
+        """
         logger.debug('Key: {} {}'.format(self.keyword, key))
 
         # take token from header and check the user againts FB graph API
@@ -58,8 +128,18 @@ class SimpleFacebookAuthentication(TokenAuthentication):
         }
 
         # try request on facebook graph api url
-        response = requests.get(app_settings.FACEBOOK_GRAPH_API_ME_URL,
-                                headers=headers)
+        try:
+            response = graph.get(app_settings.FACEBOOK_GRAPH_API_ME_URL,
+                                 headers=headers)
+        except (graph.CircuitOpen, requests.RequestException) as e:
+            logger.error(e)
+            raise ServiceUnavailable()
+
+        # failure of facebook graph api is not failure of authentication
+        if response.status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+            logger.error('Facebook Graph API status code: {}'.format(
+                response.status_code))
+            raise ServiceUnavailable()
 
         response_body = None
         error = None
@@ -76,7 +156,7 @@ class SimpleFacebookAuthentication(TokenAuthentication):
                     error = response_body.get('error')
                 except Exception as e:
                     logger.debug(e)
-                    raise exceptions.AuthenticationFailed(
+                    raise InvalidFacebookToken(
                         _('Authentication failed.')
                     )
 
@@ -99,7 +179,7 @@ class SimpleFacebookAuthentication(TokenAuthentication):
                     )
 
                     # return authorization URL in response for the client
-                    raise exceptions.AuthenticationFailed(
+                    raise InvalidFacebookToken(
                         detail={
                             'detail': _('Ivalid token'),
                             'redirect_url': authorization_url,
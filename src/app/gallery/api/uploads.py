@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from django.db import transaction
+from .. import settings as app_settings
+from ..cache import invalidate_images, thumbnail_cache
+from ..executors import LazyExecutor
+from ..models import Image, storage
+from ..tasks import prerender_thumbnails
+from .serializers import ImageUploadSerializer
+
+
+logger = logging.getLogger(__name__)
+
+
+_executor = LazyExecutor('UPLOAD_WORKERS', 'gallery-upload')
+
+
+def get_executor():
+    """
+    Returns thread pool for validation and storing of uploaded files. Pool is
+    created with the first upload.
+    """
+    return _executor.get()
+
+
+def _prepare_image(gallery, file, fb_user):
+    """
+    Validates uploaded `file` and stores it to the storage. Returns tuple of
+    unsaved `Image` instance and `None`, or `None` and validation errors.
+    """
+    data = Image.create_from_file(gallery, file, fb_user)
+    serializer = ImageUploadSerializer(data=data)
+    if not serializer.is_valid():
+        return None, serializer.errors
+
+    image = Image(gallery=gallery, **serializer.validated_data)
+    image.store_file()
+    image.path = os.path.basename(image.file.name)
+    image.fullpath = Image.get_fullpath(gallery.path, image.path)
+    return image, None
+
+
+def upload_images(gallery, files, fb_user):
+    """
+    Uploads `files` (list of Django `UploadedFile` objects) to the `gallery`.
+    Files are validated and stored in the thread pool, images are inserted to
+    the database with one bulk insert.
+
+    Returns tuple of the list of created images and the list of errors
+    (dictionaries with `name` of the file and its `error`).
+    """
+    futures = [get_executor().submit(_prepare_image, gallery, file, fb_user)
+               for file in files]
+
+    results = []
+    failure = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            failure = e
+            results.append((None, None))
+
+    images = [image for image, errors in results if image is not None]
+
+    # do not leave stored files of the failed upload
+    if failure is not None:
+        for image in images:
+            storage.delete(image.file.name)
+        raise failure
+
+    errors = [
+        {'name': file.name, 'error': errors}
+        for file, (image, errors) in zip(files, results) if errors is not None
+    ]
+
+    if not images:
+        return images, errors
+
+    try:
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+    except Exception:
+        for image in images:
+            storage.delete(image.file.name)
+        raise
+
+    # primary keys are not returned from bulk insert by all the databases
+    if any(image.pk is None for image in images):
+        pks = dict(Image.objects.filter(
+            fullpath__in=[image.fullpath for image in images]
+        ).values_list('fullpath', 'pk'))
+        for image in images:
+            image.pk = pks[image.fullpath]
+
+    # bulk insert does not send `post_save` signals
+    invalidate_images([image.fullpath for image in images])
+    for image in images:
+        thumbnail_cache.invalidate(gallery.name, image.path)
+        transaction.on_commit(
+            lambda image_pk=image.pk: prerender_thumbnails(image_pk))
+
+    return images, errors
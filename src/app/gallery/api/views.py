@@ -1,15 +1,41 @@
+import json
 import logging
-from django.http import FileResponse
+import mimetypes
+from django.http import (
+    HttpResponse, HttpResponsePermanentRedirect, StreamingHttpResponse
+)
+from django.urls import reverse
+from django.utils.encoding import escape_uri_path
+from django.utils.translation import gettext as _
 from rest_framework import status
 from rest_framework.decorators import api_view, authentication_classes, \
-    permission_classes
+    permission_classes, renderer_classes
 from rest_framework.exceptions import APIException, NotFound
 from rest_framework.response import Response
-from ..models import Gallery, Image
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from app.db_routers import replica_reads
+from .. import settings as app_settings
+from ..cache import (
+    CachedThumbnail, cache_image, cache_thumbnail, get_cached_image,
+    invalidate_images, is_thumbnail_cached, thumbnail_cache
+)
+from ..models import Gallery, Image, Thumbnail, storage
+from ..rendering import RenderingUnavailable, get_output_formats
+from ..uploadhandlers import UploadBudgetHandler
+from .exceptions import ServiceUnavailable
+from .negotiation import ImageContentNegotiation, content_negotiation_class
+from .pagination import GalleryCursorPagination
+from .renderers import NDJSONRenderer
+from .responses import (
+    get_accepted_format, get_file_response, get_image_etag,
+    get_not_modified_response, set_validators
+)
 from .serializers import (
-    GallerySerializer, GalleryDetailSerializer, ImageUploadSerializer,
+    GallerySerializer, GalleryDetailSerializer, ImageSerializer,
     ImagePreviewSerializer
 )
+from .uploads import upload_images
 from .simple_fb_auth import SimpleFacebookAuthentication, IsFacebookAuthenticated
 
 
@@ -34,12 +60,13 @@ def get_gallery(path):
 def get_image(gallery_path, image_path):
     """
     Selects `image` from database based on its `gallery_path` and `image_path`
-    attributes.
+    attributes. Image is selected by its unique `fullpath`, without join of
+    the gallery.
     """
     image = None
     try:
-        image = Image.objects.get(gallery__name=gallery_path,
-                                  path=image_path)
+        image = Image.objects.get(fullpath=Image.get_fullpath(
+            escape_uri_path(gallery_path), image_path))
     except Image.DoesNotExist:
         raise NotFound()
     except Exception as e:
@@ -49,19 +76,105 @@ def get_image(gallery_path, image_path):
     return image
 
 
+def resolve_image(gallery_path, image_path):
+    """
+    Returns `image` like `get_image`, but the image is served from the cache
+    when it was resolved recently. It is meant for reading, cached image has
+    no related gallery loaded.
+    """
+    fullpath = Image.get_fullpath(escape_uri_path(gallery_path), image_path)
+    image = get_cached_image(fullpath)
+    if image is None:
+        image = get_image(gallery_path, image_path)
+        cache_image(image)
+
+    return image
+
+
+def get_file_size(image):
+    """
+    Returns size of the `image` file. When the file is missing (image was
+    deleted by other process after it was cached), image is removed from the
+    cache and `NotFound` is raised.
+    """
+    try:
+        return image.file.size
+    except FileNotFoundError:
+        invalidate_images([image.fullpath])
+        raise NotFound()
+
+
+def render_thumbnail(image, x_size, y_size, image_format=None):
+    """
+    Returns name of the thumbnail like `Image.render_thumbnail`, but the
+    thumbnails found in the `Thumbnail` manifest are cached next to the
+    resolved images, so they are not looked up in database again.
+    """
+    name = image.get_thumbnail_name_with_path(x_size, y_size, image_format)
+    if is_thumbnail_cached(image.pk, name):
+        Thumbnail.touch_names([name])
+        return name
+
+    name = image.render_thumbnail(x_size, y_size, image_format)
+    cache_thumbnail(image.pk, name)
+    return name
+
+
+def stream_gallery_detail(gallery, ndjson=False):
+    """
+    Generator of the gallery detail for streaming response. Images are read
+    from database in chunks and serialized one by one, so the whole list of
+    images is never in memory.
+
+    With `ndjson` it generates only images, one JSON document per line.
+    Otherwise, it generates the same JSON document as `GalleryDetailSerializer`.
+    """
+    serializer = ImageSerializer()
+    images = gallery.image_set.order_by('created', 'pk') \
+                              .values('path', 'fullpath', 'name', 'modified') \
+                              .iterator(chunk_size=app_settings.STREAMING_CHUNK_SIZE)
+
+    if not ndjson:
+        header = json.dumps({'path': gallery.path, 'name': gallery.name},
+                            cls=JSONEncoder, ensure_ascii=False)
+        yield '{}, "images": ['.format(header[:-1])
+
+    for i, image in enumerate(images):
+        data = serializer.to_representation(image)
+
+        if ndjson:
+            yield NDJSONRenderer.render_line(data)
+        else:
+            separator = ', ' if i else ''
+            yield separator + json.dumps(data, cls=JSONEncoder,
+                                         ensure_ascii=False)
+
+    if not ndjson:
+        yield ']}'
+
+
 @api_view(['GET', 'POST'])
 @authentication_classes([])
 @permission_classes([])
+@replica_reads
 def gallery_list_view(request):
     """
     Gallery list entrypoint.
 
     - `GET` method selects all the galleries from database. Part of retrieved
-    gallery objects is one of gallery image as a preview.
+    gallery objects is one of gallery image as a preview. With `limit` query
+    parameter, galleries are paginated with `cursor`.
     - `POST` creates new gallery. Name of the gallery must be unique.
     """
     if request.method == 'GET':
-        galleries = Gallery.objects.all()
+        galleries = Gallery.objects.with_preview()
+
+        paginator = GalleryCursorPagination()
+        page = paginator.paginate_queryset(galleries, request)
+        if page is not None:
+            serializer = GallerySerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
+
         serializer = GallerySerializer(galleries, many=True)
         return Response(serializer.data)
 
@@ -80,18 +193,42 @@ def gallery_list_view(request):
 @api_view(['GET', 'DELETE', 'POST'])
 @authentication_classes([SimpleFacebookAuthentication])
 @permission_classes([IsFacebookAuthenticated])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer])
+@replica_reads
 def gallery_detail_view(request, path):
     """
     Gallery detail entrypoint.
 
     - `GET` method selects gallery detail based on `path` attribute of gallery.
     Returned object includes all of the images, belongs to selected gallery.
+    With `limit` query parameter, images are paginated with `cursor`. With
+    `stream` query parameter, response is streamed. Streamed response with
+    `application/x-ndjson` media type contains only images, one per line.
     - `POST` method is used for uploading images to selected gallery. It is
-    possible to upload more than one image.
+    possible to upload more than one image, up to `UPLOAD_MAX_FILES` files
+    with `UPLOAD_MAX_BYTES` bytes.
     - `DELETE` method deletes selected gallery with all the images.
     """
     if request.method == 'GET':
         gallery = get_gallery(path)
+
+        ndjson = request.accepted_renderer.format == NDJSONRenderer.format
+        if ndjson or request.query_params.get('stream'):
+            return StreamingHttpResponse(
+                stream_gallery_detail(gallery, ndjson=ndjson),
+                content_type=(NDJSONRenderer.media_type if ndjson
+                              else 'application/json'),
+            )
+
+        paginator = GalleryCursorPagination()
+        page = paginator.paginate_queryset(gallery.image_set.all(), request)
+        if page is not None:
+            serializer = GalleryDetailSerializer(gallery,
+                                                 context={'images': page})
+            return Response(dict(serializer.data,
+                                 next=paginator.get_next_link(),
+                                 previous=paginator.get_previous_link()))
+
         serializer = GalleryDetailSerializer(gallery)
         return Response(serializer.data)
 
@@ -105,27 +242,38 @@ def gallery_detail_view(request, path):
         # find galery
         gallery = get_gallery(path)
 
+        # files are streamed to temporary files within the budget
+        budget = UploadBudgetHandler(
+            request,
+            max_files=app_settings.UPLOAD_MAX_FILES,
+            max_bytes=app_settings.UPLOAD_MAX_BYTES,
+        )
+        request.upload_handlers.insert(0, budget)
+
+        files = request.FILES
+
+        if budget.exceeded:
+            return Response(
+                {'detail': _('Upload is too large.')},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+
         # in case of no files in body, return bad request
-        if not request.FILES:
+        if not files:
             return Response({}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            for key, val in request.FILES.items():
-                image = Image.create_from_file(gallery, val, request.user)
-                serializer = ImageUploadSerializer(data=image)
-                if serializer.is_valid():
-                    img = serializer.save()
-                    success_response['uploaded'].append({
-                        'name': img.name,
-                        'path': img.path,
-                        'fullpath': img.fullpath,
-                        'modified': img.modified,
-                    })
-                else:
-                    success_response['errors'].append({
-                        'name': val.name,
-                        'error': serializer.errors
-                    })
+            images, errors = upload_images(gallery, list(files.values()),
+                                           request.user)
+
+            for img in images:
+                success_response['uploaded'].append({
+                    'name': img.name,
+                    'path': img.path,
+                    'fullpath': img.fullpath,
+                    'modified': img.modified,
+                })
+            success_response['errors'] = errors
 
             return Response(success_response, status=status.HTTP_200_OK)
         except Exception as e:
@@ -138,21 +286,35 @@ def gallery_detail_view(request, path):
         return Response(None, status=status.HTTP_200_OK)
 
 
+@content_negotiation_class(ImageContentNegotiation)
 @api_view(['GET', 'DELETE'])
 @authentication_classes([])
 @permission_classes([])
+@replica_reads
 def image_detail_view(request, gallery_path, image_path):
     """
     Image detail entrypoint.
 
     - `GET` method returns image detail from database. Searchig is based on
-    `gallery_path` and `image_path` attributes.
+    `gallery_path` and `image_path` attributes. Conditional requests are
+    answered with `304 Not Modified` without opening the file. `Range`
+    requests are answered with the requested parts of the file.
     - `DELETE` method deletes image from gallery.
     """
     if request.method == 'GET':
         logger.debug('GET Image {}/{}'.format(gallery_path, image_path))
-        image = get_image(gallery_path, image_path)
-        return FileResponse(image.file.file)
+        image = resolve_image(gallery_path, image_path)
+
+        file_size = get_file_size(image)
+        etag = get_image_etag(image, file_size)
+        not_modified = get_not_modified_response(request, etag,
+                                                 image.modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = get_file_response(request, image.file.name, etag,
+                                     image.modified, file_size)
+        return set_validators(response, etag, image.modified)
 
     elif request.method == 'DELETE':
         logger.debug('DELETE Image {}/{}'.format(gallery_path, image_path))
@@ -162,16 +324,22 @@ def image_detail_view(request, gallery_path, image_path):
     return Response(None, status=status.HTTP_200_OK)
 
 
+@content_negotiation_class(ImageContentNegotiation)
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([])
+@replica_reads
 def image_preview_view(request, x_size, y_size, gallery_path, image_path):
     """
     Image preview (thumbnail) entrypoint.
 
     - `GET` method returns image thumbnail with `x_size` and `y_size`. If one
     of size values is zero, resizing method preserves ratio. Image selection
-    is based on `gallery_path` and `image_path` attributes.
+    is based on `gallery_path` and `image_path` attributes. Conditional
+    requests are answered with `304 Not Modified` without opening the file.
+    Size is checked with `THUMBNAIL_SIZE_POLICY` and `THUMBNAIL_MAX_SIZE`.
+    Format of the thumbnail is negotiated with `Accept` header (see
+    `THUMBNAIL_FORMATS`), each format is a separate variant of the thumbnail.
     """
     if request.method == 'GET':
         logger.debug(('GET Image preview x={x_size}, y={y_size}, path={gallery_path}/{image_path}'
@@ -180,14 +348,83 @@ def image_preview_view(request, x_size, y_size, gallery_path, image_path):
 
         serializer = ImagePreviewSerializer(data={'x_size': x_size, 'y_size': y_size})
         if serializer.is_valid():
-            image = get_image(gallery_path, image_path)
+            size = (serializer.validated_data['x_size'],
+                    serializer.validated_data['y_size'])
+
+            # canonical URL of the thumbnail size
+            if (app_settings.THUMBNAIL_SIZE_POLICY == 'redirect'
+                    and size != (x_size, y_size)):
+                return HttpResponsePermanentRedirect(reverse(
+                    'gallery:image-preview',
+                    kwargs={'x_size': size[0], 'y_size': size[1],
+                            'gallery_path': gallery_path,
+                            'image_path': image_path}))
+
+            # snapped size
+            x_size, y_size = size
+
+            image_format = get_accepted_format(request, image_path)
+            variant = [x_size, y_size] + ([image_format] if image_format
+                                          else [])
+            cache_control = app_settings.THUMBNAIL_CACHE_CONTROL
+            vary = ['Accept'] if get_output_formats() else None
+
+            image = resolve_image(gallery_path, image_path)
+            thumbnail_name = image.get_thumbnail_name_with_path(
+                x_size, y_size, image_format)
+
+            # hot thumbnails are served from memory, when they were rendered
+            # from the current version of the image
+            cache_key = thumbnail_cache.get_key(gallery_path, image_path,
+                                                x_size, y_size, image_format)
+            cached = thumbnail_cache.get(cache_key, image.modified)
+            if cached is not None:
+                # thumbnails accessed only from memory are not evicted first
+                Thumbnail.touch_names([thumbnail_name])
+                response = get_not_modified_response(request, cached.etag,
+                                                     cached.modified)
+                if response is None:
+                    response = HttpResponse(cached.content,
+                                            content_type=cached.content_type)
+                return set_validators(response, cached.etag, cached.modified,
+                                      cache_control, vary)
+
+            etag = get_image_etag(image, get_file_size(image), *variant)
+            not_modified = get_not_modified_response(request, etag,
+                                                     image.modified)
+            if not_modified is not None:
+                Thumbnail.touch_names([thumbnail_name])
+                return set_validators(not_modified, etag, image.modified,
+                                      cache_control, vary)
+
             # resize image
             try:
-                resized_image = image.get_thumbnail(x_size, y_size)
+                thumbnail_name = render_thumbnail(image, x_size, y_size,
+                                                  image_format)
+            except RenderingUnavailable as e:
+                logger.warning(e)
+                raise ServiceUnavailable()
             except Exception as e:
                 logger.error(e)
                 raise APIException()
 
-            return FileResponse(resized_image)
+            # offloaded thumbnails are not cached in memory
+            if (not thumbnail_cache.max_bytes
+                    or app_settings.IMAGE_DELIVERY_BACKEND != 'direct'):
+                response = get_file_response(request, thumbnail_name, etag,
+                                             image.modified)
+                return set_validators(response, etag, image.modified,
+                                      cache_control, vary)
+
+            with storage.open(thumbnail_name) as resized_image:
+                content = resized_image.read()
+
+            content_type = mimetypes.guess_type(thumbnail_name)[0]
+            thumbnail_cache.set(cache_key, CachedThumbnail(
+                image.modified, etag, content_type, content))
+
+            return set_validators(
+                HttpResponse(content, content_type=content_type),
+                etag, image.modified, cache_control, vary)
 
         return Response(serializer.errors, status=status.HTTP_200_OK)
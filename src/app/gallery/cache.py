@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from . import settings as app_settings
+from .models import Image
+
+
+logger = logging.getLogger(__name__)
+
+
+CachedThumbnail = namedtuple('CachedThumbnail',
+                             ['modified', 'etag', 'content_type', 'content'])
+
+
+class ThumbnailCache:
+    """
+    In-process LRU cache of rendered thumbnails with the byte budget.
+
+    Entries are keyed by `gallery_path`, `image_path`, `x_size`, `y_size` and
+    `image_format` of the thumbnail and they hold `modified` timestamp of the
+    image they were rendered from. Entry is returned only for the same
+    `modified` as the resolved image has, so the entries of images changed by
+    other processes are never served. The model signals invalidate entries
+    of the images changed in this process immediately.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(gallery_path, image_path, x_size, y_size, image_format=None):
+        return (gallery_path, image_path, x_size, y_size, image_format)
+
+    @property
+    def size(self):
+        """
+        Number of bytes of all the cached thumbnails.
+        """
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, modified):
+        """
+        Returns `CachedThumbnail` for the `key` or `None` if it's not cached.
+        Entry rendered from the image with other than `modified` timestamp is
+        dropped and `None` is returned.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.modified != modified:
+                self._pop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        """
+        Stores `CachedThumbnail` under the `key`. Least recently used entries
+        are evicted until the cache fits to the byte budget. Thumbnails bigger
+        than the whole budget are not cached at all.
+        """
+        entry_size = len(entry.content)
+        if entry_size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = entry
+            self._size += entry_size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.content)
+
+    def invalidate(self, gallery_path, image_path=None):
+        """
+        Removes all the cached thumbnails of the image, or of the whole
+        gallery when `image_path` is not set.
+        """
+        with self._lock:
+            keys = [key for key in self._entries
+                    if key[0] == gallery_path
+                    and (image_path is None or key[1] == image_path)]
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.content)
+
+
+thumbnail_cache = ThumbnailCache(app_settings.THUMBNAIL_CACHE_MAX_BYTES)
+
+
+# local memory caches used instead of the caches not configured in `CACHES`
+_local_caches = {}
+
+
+def get_cache(alias, fallback_name):
+    """
+    Returns cache with `alias` from `CACHES`. When it's not configured,
+    returns local memory cache `fallback_name` of this process.
+    """
+    if alias in settings.CACHES:
+        return caches[alias]
+    return _local_caches.setdefault(fallback_name,
+                                    LocMemCache(fallback_name, {}))
+
+
+def get_lookup_cache():
+    """
+    Returns cache for the images resolved from their URL.
+    """
+    return get_cache(app_settings.IMAGE_LOOKUP_CACHE, 'gallery-images')
+
+
+def get_lookup_cache_key(fullpath):
+    """
+    Returns cache key for the image with `fullpath`.
+    """
+    return 'gallery:image:{}'.format(
+        hashlib.sha256(fullpath.encode('utf-8')).hexdigest())
+
+
+def get_cached_image(fullpath):
+    """
+    Returns `Image` with `fullpath` built from the cached values of its
+    fields, or `None` when it's not cached. Related gallery is not cached, it
+    is selected from database when it is accessed.
+    """
+    if not app_settings.IMAGE_LOOKUP_CACHE_TTL:
+        return None
+
+    values = get_lookup_cache().get(get_lookup_cache_key(fullpath))
+    if values is None:
+        return None
+
+    field_names = [field.attname for field in Image._meta.concrete_fields]
+    return Image.from_db(None, field_names, values)
+
+
+def cache_image(image):
+    """
+    Stores values of all the fields of the `image` to the cache.
+    """
+    if not app_settings.IMAGE_LOOKUP_CACHE_TTL:
+        return
+
+    values = [image.file.name if field.name == 'file'
+              else getattr(image, field.attname)
+              for field in Image._meta.concrete_fields]
+    get_lookup_cache().set(get_lookup_cache_key(image.fullpath), values,
+                           app_settings.IMAGE_LOOKUP_CACHE_TTL)
+
+
+def invalidate_images(fullpaths):
+    """
+    Removes cached images with `fullpaths`.
+    """
+    get_lookup_cache().delete_many(
+        [get_lookup_cache_key(fullpath) for fullpath in fullpaths])
+
+
+def get_thumbnail_cache_key(image_pk, name):
+    """
+    Returns cache key for the thumbnail `name` of the image with `image_pk`.
+    """
+    return 'gallery:thumbnail:{}'.format(hashlib.sha256(
+        '{}:{}'.format(image_pk, name).encode('utf-8')).hexdigest())
+
+
+def is_thumbnail_cached(image_pk, name):
+    """
+    Returns `True`, when the thumbnail `name` of the image with `image_pk` is
+    cached as recorded in the `Thumbnail` manifest.
+    """
+    if not app_settings.IMAGE_LOOKUP_CACHE_TTL:
+        return False
+
+    return get_lookup_cache().get(
+        get_thumbnail_cache_key(image_pk, name)) is not None
+
+
+def cache_thumbnail(image_pk, name):
+    """
+    Caches, that the thumbnail `name` of the image with `image_pk` is recorded
+    in the `Thumbnail` manifest. Thumbnails are cached next to the resolved
+    images, so the preview of the cached image does not query database.
+    """
+    if not app_settings.IMAGE_LOOKUP_CACHE_TTL:
+        return
+
+    get_lookup_cache().set(get_thumbnail_cache_key(image_pk, name), True,
+                           app_settings.IMAGE_LOOKUP_CACHE_TTL)
+
+
+def invalidate_thumbnail(image_pk, name):
+    """
+    Removes cached thumbnail `name` of the image with `image_pk`.
+    """
+    get_lookup_cache().delete(get_thumbnail_cache_key(image_pk, name))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import settings as app_settings
+
+
+class LazyExecutor:
+    """
+    Pool of workers, which is created with the first job.
+
+    `max_workers` is the name of the app setting with the size of the pool,
+    it's read when the pool is created. Threads of the pool are named with
+    `thread_name_prefix`. Process pool is created with `executor_class`
+    `ProcessPoolExecutor`, other `kwargs` are passed to the executor.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix=None,
+                 executor_class=ThreadPoolExecutor, **kwargs):
+        if thread_name_prefix is not None:
+            kwargs['thread_name_prefix'] = thread_name_prefix
+        self.max_workers = max_workers
+        self.executor_class = executor_class
+        self.kwargs = kwargs
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the pool, it's created with the first call.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = self.executor_class(
+                    max_workers=getattr(app_settings, self.max_workers),
+                    **self.kwargs)
+        return self._executor
+
+    def shutdown(self, wait=True):
+        """
+        Shuts the pool down, the new one is created with the next job.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.core.exceptions import RequestAborted
+from django.core.handlers.asgi import ASGIHandler
+from django.core import signals
+from django.db import close_old_connections, connections
+from django.http import FileResponse
+from django.urls import set_script_prefix
+from .executors import LazyExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+_file_executor = LazyExecutor('FILE_READ_WORKERS', 'gallery-file')
+
+
+class GalleryASGIHandler(ASGIHandler):
+    """
+    ASGI handler, which does not block the event loop with file transfers.
+
+    Views run in the thread pool and they hold the thread only until the
+    response is ready (database queries, authentication, thumbnail
+    rendering). Files of image and thumbnail responses are then read chunk by
+    chunk in the shared pool of `FILE_READ_WORKERS` threads and sent
+    asynchronously, so slow clients downloading images hold no thread between
+    the chunks. The other streaming responses (e.g. streamed gallery detail)
+    query database while they are iterated, so each of them is iterated in
+    its own thread.
+    """
+
+    async def __call__(self, scope, receive, send):
+        """
+        Async entrypoint - parses the request and hands off to get_response.
+        """
+        if scope['type'] != 'http':
+            raise ValueError(
+                'Django can only handle ASGI/HTTP connections, not %s.'
+                % scope['type']
+            )
+
+        try:
+            body_file = await self.read_body(receive)
+        except RequestAborted:
+            return
+
+        set_script_prefix(self.get_script_prefix(scope))
+
+        # requests are not serialized to one thread
+        response = await sync_to_async(self.handle_request,
+                                       thread_sensitive=False)(scope, body_file)
+        await self.send_response(response, send)
+
+    def handle_request(self, scope, body_file):
+        """
+        Returns response to the request. Request is started and the view runs
+        in one thread, the response without streaming content is finished
+        (closed) there too, so `request_finished` signal closes database
+        connections of the thread, which were used by the view.
+        """
+        signals.request_started.send(sender=self.__class__, scope=scope)
+
+        request, response = self.create_request(scope, body_file)
+        if request is not None:
+            response = self.get_response(request)
+            response._handler_class = self.__class__
+
+        if isinstance(response, FileResponse):
+            response.block_size = self.chunk_size
+
+        if not response.streaming:
+            response.close()
+        else:
+            # streaming response is finished in the other thread
+            close_old_connections()
+        return response
+
+    async def send_response(self, response, send):
+        """
+        Sends response. Content of the streaming responses is read in the
+        thread, files in the shared pool (see `get_file_executor`), the other
+        content in the dedicated thread, which closes its database
+        connections after the response is closed.
+        """
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b'Set-Cookie', c.output(header='').encode('ascii').strip())
+            )
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+
+        # response is already closed by `handle_request`
+        if not response.streaming:
+            for chunk, last in self.chunk_bytes(response.content):
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': not last,
+                })
+            return
+
+        loop = asyncio.get_event_loop()
+        if isinstance(response, FileResponse):
+            executor, dedicated = get_file_executor(), None
+        else:
+            executor = dedicated = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='gallery-response')
+
+        parts = iter(response)
+        try:
+            while True:
+                part = await loop.run_in_executor(executor, next, parts, None)
+                if part is None:
+                    break
+
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+
+            await send({'type': 'http.response.body'})
+        finally:
+            if dedicated is None:
+                await loop.run_in_executor(executor, response.close)
+            else:
+                await loop.run_in_executor(dedicated, self.close_response,
+                                           response)
+                dedicated.shutdown(wait=False)
+
+    @staticmethod
+    def close_response(response):
+        """
+        Closes the response in its dedicated thread, database connections of
+        the thread are closed, because the thread ends with the response.
+        """
+        try:
+            response.close()
+        finally:
+            connections.close_all()
+
+
+def get_file_executor():
+    """
+    Returns the thread pool, which reads files of the responses.
+    """
+    return _file_executor.get()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+# in-process locks keyed by the lock file path, with number of their users
+_locks = {}
+_locks_guard = threading.Lock()
+
+# seconds between attempts to acquire the lock file
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    """
+    Lock was not acquired in time.
+    """
+    pass
+
+
+@contextmanager
+def file_lock(path, timeout=None):
+    """
+    Exclusive lock identified by the `path` of the lock file.
+
+    Threads of the current process are serialized with in-memory lock, other
+    worker processes with `flock` on the lock file. Lock file is created when
+    it does not exist and it is left in place after release.
+
+    When the lock is not acquired in `timeout` seconds, `LockTimeout` is
+    raised. Without `timeout`, it waits until the lock is released.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    with _locks_guard:
+        entry = _locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        if not entry[0].acquire(timeout=-1 if deadline is None
+                                else max(deadline - time.monotonic(), 0)):
+            raise LockTimeout('Lock {} was not acquired in time.'.format(path))
+
+        try:
+            with open(path, 'a') as lock_file:
+                _flock(lock_file, deadline)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            entry[0].release()
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _locks[path]
+
+
+def _flock(lock_file, deadline):
+    """
+    Acquires `flock` of the `lock_file`, polling it until the `deadline`
+    (`time.monotonic` value) when it's set.
+    """
+    if deadline is None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise LockTimeout('Lock {} was not acquired in time.'.format(
+                    lock_file.name))
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,29 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from app.gallery import settings as app_settings
+from app.gallery.tasks import evict_thumbnails
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Evicts least recently used thumbnails above the quota.
+    """
+    help = 'Delete least recently used thumbnails above the byte quota.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quota', type=int, default=None,
+                            help='Quota in bytes. Default is THUMBNAIL_QUOTA_BYTES.')
+
+    def handle(self, *args, **options):
+        quota = options['quota']
+        if quota is None:
+            quota = app_settings.THUMBNAIL_QUOTA_BYTES
+        if quota is None:
+            raise CommandError('Set THUMBNAIL_QUOTA_BYTES or --quota option.')
+
+        count, freed = evict_thumbnails(quota)
+        self.stdout.write('Evicted {} thumbnails, {} bytes freed.'.format(
+            count, freed))
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.3 on 2026-10-18 10:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0009_auto_20200203_1458'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gallery',
+            index=models.Index(fields=['created', 'id'], name='gallery_gal_created_662718_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['gallery', 'created', 'id'], name='gallery_ima_gallery_249b1e_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.0.3 on 2026-10-18 10:41
+
+from django.db import migrations, models
+from django.utils.encoding import escape_uri_path
+
+
+def backfill_fullpath(apps, schema_editor):
+    Image = apps.get_model('gallery', 'Image')
+
+    batch = []
+    images = Image.objects.select_related('gallery').only('path', 'gallery__name')
+    for image in images.iterator(chunk_size=1000):
+        image.fullpath = '{}/{}'.format(escape_uri_path(image.gallery.name),
+                                        image.path)
+        batch.append(image)
+        if len(batch) == 1000:
+            Image.objects.bulk_update(batch, ['fullpath'])
+            batch = []
+
+    Image.objects.bulk_update(batch, ['fullpath'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0010_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='fullpath',
+            field=models.CharField(blank=True, help_text='Full path is composed from gallery `name` and image path. It will be populated automatically.', max_length=1024, null=True, unique=True, verbose_name='Full path'),
+        ),
+        migrations.RunPython(backfill_fullpath, migrations.RunPython.noop),
+    ]
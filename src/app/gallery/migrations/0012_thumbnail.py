@@ -0,0 +1,39 @@
+# Generated by Django 3.0.3 on 2026-10-18 10:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0011_image_fullpath'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('x_size', models.PositiveSmallIntegerField(help_text='Requested width. Zero, when it is calculated from height.', verbose_name='Requested width')),
+                ('y_size', models.PositiveSmallIntegerField(help_text='Requested height. Zero, when it is calculated from width.', verbose_name='Requested height')),
+                ('width', models.PositiveSmallIntegerField(help_text='Width of the rendered thumbnail.', verbose_name='Width')),
+                ('height', models.PositiveSmallIntegerField(help_text='Height of the rendered thumbnail.', verbose_name='Height')),
+                ('format', models.CharField(help_text='Image format of the thumbnail (e.g. JPEG).', max_length=16, verbose_name='Format')),
+                ('name', models.CharField(help_text='Name of the thumbnail file in the storage.', max_length=1024, verbose_name='Name')),
+                ('bytes', models.PositiveIntegerField(help_text='Size of the thumbnail file.', verbose_name='Bytes')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='Timestamp of creation.', verbose_name='Created')),
+                ('last_accessed', models.DateTimeField(default=django.utils.timezone.now, help_text='Timestamp of last access. It is updated at most once per `THUMBNAIL_ACCESS_UPDATE_INTERVAL`.', verbose_name='Last accessed')),
+                ('image', models.ForeignKey(help_text='Thumbnail of the image.', on_delete=django.db.models.deletion.CASCADE, to='gallery.Image', verbose_name='Image')),
+            ],
+            options={
+                'verbose_name': 'Thumbnail',
+                'verbose_name_plural': 'Thumbnails',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='thumbnail',
+            constraint=models.UniqueConstraint(fields=('image', 'x_size', 'y_size', 'format'), name='unique_thumbnail_variant'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.3 on 2026-10-18 10:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0012_thumbnail'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='thumbnail',
+            index=models.Index(fields=['last_accessed', 'id'], name='gallery_thu_last_ac_601cfb_idx'),
+        ),
+    ]
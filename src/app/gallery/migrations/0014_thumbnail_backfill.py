@@ -0,0 +1,101 @@
+# Generated by Django 3.0.3 on 2026-10-18 11:09
+
+import os
+import re
+from django.conf import settings
+from django.core.files.storage import get_storage_class
+from django.db import migrations
+from PIL import Image as PILImage
+
+
+# thumbnail "<filename>_<x_size>x<y_size><extension>" of "<filename><extension>"
+THUMBNAIL_NAME = re.compile(r'(.*)_(\d+)x(\d+)(\.[^.]*)?$')
+
+
+def get_thumbnail_files(path):
+    """
+    Returns thumbnail files in the directory `path` as dictionary of lists of
+    `(x_size, y_size, thumbnail_basename)` tuples by basename of the image.
+    """
+    thumbnails = {}
+    if not os.path.isdir(path):
+        return thumbnails
+
+    for basename in os.listdir(path):
+        match = THUMBNAIL_NAME.match(basename)
+        if match is None:
+            continue
+
+        filename, x_size, y_size, extension = match.groups()
+        thumbnails.setdefault(filename + (extension or ''), []).append(
+            (int(x_size), int(y_size), basename))
+    return thumbnails
+
+
+def backfill_thumbnails(apps, schema_editor):
+    """
+    Records thumbnails rendered before the `Thumbnail` manifest, so they are
+    deleted with their images and they count to the quota.
+    """
+    Image = apps.get_model('gallery', 'Image')
+    Thumbnail = apps.get_model('gallery', 'Thumbnail')
+
+    storage = get_storage_class()()
+    subdirectory = getattr(settings, 'THUMBNAILS_SUBDIRECTORY', 'thumbnails')
+
+    # images of one gallery share the thumbnail directory, it's listed once
+    directory = None
+    thumbnails = {}
+    recorded = set()
+
+    batch = []
+    images = Image.objects.only('file').order_by('gallery_id', 'pk')
+    for image in images.iterator(chunk_size=1000):
+        image_directory = os.path.join(os.path.dirname(image.file.name),
+                                       subdirectory)
+        if image_directory != directory:
+            directory = image_directory
+            thumbnails = get_thumbnail_files(storage.path(directory))
+            recorded = set(Thumbnail.objects.filter(
+                name__startswith=directory + '/').values_list('name', flat=True))
+
+        basename = os.path.basename(image.file.name)
+        for x_size, y_size, thumbnail_basename in thumbnails.get(basename, []):
+            name = os.path.join(directory, thumbnail_basename)
+            if name in recorded:
+                continue
+
+            try:
+                with PILImage.open(storage.path(name)) as thumbnail:
+                    width, height = thumbnail.size
+                    image_format = thumbnail.format
+            except Exception:
+                continue
+
+            batch.append(Thumbnail(
+                image_id=image.pk,
+                x_size=x_size,
+                y_size=y_size,
+                name=name,
+                format=image_format,
+                width=width,
+                height=height,
+                bytes=storage.size(name),
+            ))
+
+        if len(batch) >= 1000:
+            Thumbnail.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+
+    Thumbnail.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0013_thumbnail_eviction_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_thumbnails, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 11:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0014_thumbnail_backfill'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='name',
+            field=models.CharField(db_index=True, help_text='Name of the thumbnail file in the storage.', max_length=1024, verbose_name='Name'),
+        ),
+    ]
@@ -2,14 +2,21 @@
 import logging
 import os
 import shutil
-from django.conf import settings
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import ExitStack
+from datetime import timedelta
 from django.core.exceptions import ValidationError
 from django.core.files.storage import get_storage_class
-from django.db import models
+from django.db import connection, models, router, transaction
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.utils.encoding import escape_uri_path
-from PIL import Image as PILImage
 from . import settings as app_settings
+from .locks import LockTimeout, file_lock
+from . import rendering
 
 
 logger = logging.getLogger(__name__)
@@ -24,6 +31,62 @@ def validate_gallery_name(value):
         raise ValidationError(_('Gallery name can\'t contain \'/\' character'))
 
 
+def get_thumbnail_lock_path(name):
+    """
+    Returns absolute path to the lock file of the thumbnail `name`. All the
+    thumbnails share `THUMBNAIL_LOCK_FILES` lock files, so the lock files do
+    not pile up with the rendered thumbnails.
+    """
+    slot = zlib.crc32(name.encode()) % app_settings.THUMBNAIL_LOCK_FILES
+    return os.path.join(storage.location, app_settings.LOCKS_SUBDIRECTORY,
+                        '{}.lock'.format(slot))
+
+
+def raw_delete(queryset, using):
+    """
+    Deletes rows selected by the `queryset` with one query, without loading
+    them, collecting their related objects and sending signals. Returns the
+    number of deleted rows.
+
+    Django has no public API for it, private `QuerySet._raw_delete` is used
+    deliberately and the tests check its signature.
+    """
+    return queryset._raw_delete(using)
+
+
+class GalleryQuerySet(models.QuerySet):
+
+    def delete(self):
+        """
+        Deletes the galleries one by one with `Gallery.delete`, so their
+        images are deleted in bulk also by the admin "delete selected" action.
+        """
+        count = 0
+        rows = Counter()
+        for gallery in self:
+            gallery_count, gallery_rows = gallery.delete()
+            count += gallery_count
+            rows.update(gallery_rows)
+        return count, dict(rows)
+
+    delete.alters_data = True
+
+    def with_preview(self):
+        """
+        Annotates galleries with attributes of their first image (`preview_*`
+        attributes), which is used as a gallery preview. Preview is selected
+        within the same query, without any query per gallery.
+        """
+        images = Image.objects.filter(gallery=models.OuterRef('pk')) \
+                              .order_by('pk')
+        return self.annotate(**{
+            'preview_{}'.format(field): models.Subquery(
+                images.values(field)[:1]
+            )
+            for field in ['pk', 'path', 'fullpath', 'name', 'modified']
+        })
+
+
 class Gallery(models.Model):
     """
     Model that represents gallery model.
@@ -48,9 +111,15 @@ class Gallery(models.Model):
         help_text=_('Timestamp of last modification.'),
     )
 
+    objects = GalleryQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Gallery')
         verbose_name_plural = _('Galleries')
+        indexes = [
+            # cursor pagination
+            models.Index(fields=['created', 'id']),
+        ]
 
     def __str__(self):
         return self.name
@@ -62,20 +131,51 @@ class Gallery(models.Model):
         """
         return escape_uri_path(self.name)
 
+    def delete(self, using=None, keep_parents=False):
+        """
+        Deletes the gallery with all its images. Images and their thumbnails
+        are deleted with one query each, they are not loaded and their
+        `post_delete` signals are not sent. Their files are deleted with the
+        gallery directory, once the deletion is committed.
+        """
+        # cache depends on the models
+        from .cache import invalidate_images
+
+        using = using or router.db_for_write(Gallery, instance=self)
+        images = Image.objects.using(using).filter(gallery=self)
+
+        # images are looked up in the cache only with `IMAGE_LOOKUP_CACHE_TTL`
+        fullpaths = []
+        with transaction.atomic(using=using):
+            if app_settings.IMAGE_LOOKUP_CACHE_TTL:
+                fullpaths = list(images.values_list('fullpath', flat=True))
+            deleted = {
+                Thumbnail._meta.label: raw_delete(
+                    Thumbnail.objects.using(using).filter(image__in=images),
+                    using),
+                Image._meta.label: raw_delete(images, using),
+            }
+            count, rows = super().delete(using, keep_parents)
+
+        if fullpaths:
+            invalidate_images(fullpaths)
+        rows.update(deleted)
+        return count + sum(deleted.values()), rows
+
+    def get_gallery_directory(self):
+        """
+        Returns absolute path to the gallery directory.
+        """
+        return os.path.join(storage.location,
+                            app_settings.GALLERIES_SUBDIRECTORY,
+                            self.path)
+
     def delete_gallery_directory(self):
         """
         Deletes gallery directory recursively with all the images and
         thumbnails.
         """
-        path = escape_uri_path(self.name)
-
-        # absolute path to gallery directory
-        absolute_path = os.path.join(storage.location,
-                                     app_settings.GALLERIES_SUBDIRECTORY,
-                                     path)
-
-        # detele recursively
-        shutil.rmtree(absolute_path)
+        shutil.rmtree(self.get_gallery_directory())
 
 
 def image_directory_path(instance, filename):
@@ -136,7 +236,8 @@ class Image(models.Model):
         null=True,
         blank=True,
         unique=True,
-        help_text=_('Full path is composed from gallery `name` and image path.'),
+        help_text=_('Full path is composed from gallery `name` and image path. '
+                    'It will be populated automatically.'),
     )
 
     name = models.CharField(
@@ -162,17 +263,22 @@ class Image(models.Model):
     class Meta:
         verbose_name = _('Image')
         verbose_name_plural = _('Images')
+        indexes = [
+            # cursor pagination of gallery images
+            models.Index(fields=['gallery', 'created', 'id']),
+        ]
 
     def __str__(self):
         return self.name or _('This image has no name')
 
-    @property
-    def fullpath(self):
+    @staticmethod
+    def get_fullpath(gallery_path, image_path):
         """
-        Fullpath of the image for access image detail in URL.  It is composed
-        by gallery path and the image filename.
+        Returns fullpath of the image for access image detail in URL. It is
+        composed by gallery path (escaped gallery name) and the image filename.
+        Images are selected by this unique key without join of the gallery.
         """
-        return '{}/{}'.format(self.gallery.path, self.path)
+        return '{}/{}'.format(gallery_path, image_path)
 
     @staticmethod
     def create_from_file(gallery, file, fb_user):
@@ -245,10 +351,25 @@ class Image(models.Model):
 
         return thumbnail_name, extension
 
-    def _generate_thumbnail(self, pil_image, x_size, y_size):
+    def get_thumbnail_name_with_path(self, x_size, y_size, image_format=None):
+        """
+        Returns name of the thumbnail with size `x_size` and `y_size` in the
+        storage. Thumbnail in other `image_format` than the original image
+        (e.g. 'WEBP') has extension of the format.
+        """
+        thumbnail_name, extension = self._get_thumbnail_name(x_size, y_size)
+        if image_format is not None:
+            extension = rendering.OUTPUT_FORMATS[image_format][1]
+
+        return os.path.join(
+            self._get_thumbnail_directory(),
+            '{}{}'.format(thumbnail_name, extension),
+        )
+
+    def _get_thumbnail_dimensions(self, x_size, y_size):
         """
-        Generates thumbanil of image (`pil_image` is Pillow image object) with
-        size `x_size` and `y_size`.
+        Calculates dimensions of thumbanil with size `x_size` and `y_size`.
+        Returns `None` if the thumbnail has original size of the image.
 
         It does NOT maintain aspect ratio, only when one of the sizes is zero.
         """
@@ -259,7 +380,7 @@ class Image(models.Model):
 
         # i don't allow to upscale images
         if x_size > img_width or y_size > img_height:
-            return pil_image
+            return None
 
         # calculate ratio
         if x_size > 0 and y_size > 0:
@@ -279,10 +400,143 @@ class Image(models.Model):
             new_dimensions = (int(round(img_width * ratio)),
                               int(round(img_height * ratio)))
 
-        # thumbnail method perserves apect ratio and updates image in place,
-        # so no `return` is needed
-        # pil_image.thumbnail(new_dimensions)
-        return pil_image.resize(new_dimensions)
+        return new_dimensions
+
+    def _get_thumbnails(self, names):
+        """
+        Returns dictionary of rendered `Thumbnail` objects of the image by
+        their `names`. Manifest of the thumbnails is read from the primary
+        database, so just rendered thumbnails are not missing there.
+        """
+        using = router.db_for_write(Thumbnail)
+        thumbnails = Thumbnail.objects.using(using) \
+                                      .filter(image=self, name__in=names)
+        return {thumbnail.name: thumbnail for thumbnail in thumbnails}
+
+    def render_thumbnails(self, sizes, image_format=None):
+        """
+        Makes sure, that thumbnails of the image with all the `sizes` (list
+        of `(x_size, y_size)` tuples) exist in the storage. Missing thumbnails
+        are rendered with one decoding of the image file and they are
+        recorded in the `Thumbnail` manifest. Returns dictionary of names of
+        the thumbnail files in the storage by their sizes.
+
+        Thumbnails are in `image_format` (one of `rendering.OUTPUT_FORMATS`),
+        or in the format of the original image, when it's not set.
+
+        Concurrent requests for the same thumbnail (from threads or other
+        worker processes) are coalesced, so thumbnail is rendered only once
+        and the others wait for the result. They wait at most
+        `THUMBNAIL_RENDER_TIMEOUT` seconds, then `RenderingUnavailable` is
+        raised.
+        """
+        names = {size: self.get_thumbnail_name_with_path(*size, image_format)
+                 for size in sizes}
+
+        # check, if thumbnails already exist
+        thumbnails = self._get_thumbnails(names.values())
+        Thumbnail.touch(thumbnails.values())
+
+        missing = sorted(size for size, name in names.items()
+                         if name not in thumbnails)
+        if not missing:
+            return names
+
+        # create `thumbnail` subdirectory, if it does not exist
+        os.makedirs(storage.path(self._get_thumbnail_directory()),
+                    exist_ok=True)
+
+        # several thumbnails can share one lock file and the locks are always
+        # acquired in the same order to avoid deadlocks
+        lock_paths = sorted({get_thumbnail_lock_path(names[size])
+                             for size in missing})
+        os.makedirs(os.path.dirname(lock_paths[0]), exist_ok=True)
+
+        deadline = time.monotonic() + app_settings.THUMBNAIL_RENDER_TIMEOUT
+        with ExitStack() as stack:
+            try:
+                for lock_path in lock_paths:
+                    stack.enter_context(file_lock(
+                        lock_path, max(deadline - time.monotonic(), 0)))
+            except LockTimeout:
+                raise rendering.RenderingUnavailable(
+                    'Thumbnail is being rendered by other request.')
+
+            # thumbnails could be rendered while we were waiting for locks
+            rendered = self._get_thumbnails([names[size] for size in missing])
+            missing = [size for size in missing
+                       if names[size] not in rendered]
+            if not missing:
+                return names
+
+            targets = [
+                (self._get_thumbnail_dimensions(*size),
+                 storage.path(names[size]))
+                for size in missing
+            ]
+            try:
+                rendered = rendering.render(self.file.path, targets,
+                                            image_format)
+            except rendering.RenderingTimeout as e:
+                # rendering goes on in the process pool, its thumbnails are
+                # recorded and the locks are released, when it's finished
+                locks = stack.pop_all()
+                e.future.add_done_callback(
+                    lambda future: threading.Thread(
+                        target=self._record_late_thumbnails,
+                        args=(future, missing, names, locks),
+                    ).start()
+                )
+                raise
+
+            self._record_thumbnails(missing, names, rendered)
+
+        return names
+
+    def _record_thumbnails(self, sizes, names, rendered):
+        """
+        Records `rendered` thumbnails (list of `rendering.RenderedThumbnail`)
+        with `sizes` and `names` in the `Thumbnail` manifest.
+        """
+        Thumbnail.objects.bulk_create([
+            Thumbnail(
+                image=self,
+                x_size=x_size,
+                y_size=y_size,
+                name=names[(x_size, y_size)],
+                format=thumbnail.format,
+                width=thumbnail.width,
+                height=thumbnail.height,
+                bytes=thumbnail.bytes,
+            )
+            for (x_size, y_size), thumbnail in zip(sizes, rendered)
+        ], ignore_conflicts=True)
+        Thumbnail.remember_accesses({names[size]: timezone.now()
+                                     for size in sizes})
+
+    def _record_late_thumbnails(self, future, sizes, names, locks):
+        """
+        Records thumbnails of the rendering, which timed out, and releases
+        its `locks`. Cancelled or failed rendering leaves no thumbnails.
+        """
+        try:
+            if not future.cancelled() and future.exception() is None:
+                self._record_thumbnails(sizes, names, future.result())
+        except Exception as e:
+            logger.error(e)
+        finally:
+            locks.close()
+            # thread is not managed by request cycle
+            connection.close()
+
+    def render_thumbnail(self, x_size, y_size, image_format=None):
+        """
+        Makes sure, that thumbnail of the image with size `x_size` and
+        `y_size` (and optional `image_format`) exists in the storage. Returns
+        name of the thumbnail file in the storage.
+        """
+        size = (x_size, y_size)
+        return self.render_thumbnails([size], image_format)[size]
 
     def get_thumbnail(self, x_size, y_size):
         """
@@ -294,45 +548,177 @@ class Image(models.Model):
         returnded. If does not exists, thumbnail file is generated, saved and
         returned.
         """
-        # generate thumbnail name
-        thumbnail_name, extension = self._get_thumbnail_name(x_size, y_size)
+        thumbnail_name_with_path = self.render_thumbnail(x_size, y_size)
+        image = storage.open(thumbnail_name_with_path)
+        return image
 
-        # thumbnail filename with subdirectory
-        thumbnail_name_with_path = os.path.join(
-            self._get_thumbnail_directory(),
-            '{}{}'.format(thumbnail_name, extension),
-        )
+    def store_file(self):
+        """
+        Stores new (not yet committed) image file to the storage and sets its
+        final name. Unlike `FieldFile.save`, the file is not assigned to the
+        field again, so `ImageField` does not open the stored file to read
+        dimensions, which are already known.
+        """
+        file = self.file
+        name = file.field.generate_filename(self, file.name)
+        file.name = file.storage.save(name, file.file,
+                                      max_length=file.field.max_length)
+        file._committed = True
 
-        # check if `thumbnail` subdirecotry exists, if not create it
-        if not storage.exists(self._get_thumbnail_directory()):
-            os.mkdir(os.path.join(storage.location,
-                                  self._get_thumbnail_directory()))
+    def delete_image_file(self):
+        """
+        Deletes image file. Thumbnails are deleted with their `Thumbnail`
+        records.
+        """
+        storage.delete(self.file.name)
 
-        # check, if thumbnail already exists. if not, create thumbnail file
-        if not storage.exists(thumbnail_name_with_path):
-            image = PILImage.open(self.file.path)
-            image = self._generate_thumbnail(image, x_size, y_size)
-            image.save(os.path.join(settings.MEDIA_ROOT,
-                                    thumbnail_name_with_path))
-            image.close()
 
-        image = storage.open(thumbnail_name_with_path)
-        return image
+# timestamps of the last accesses recorded by this process, by the names of
+# the thumbnails, so the thumbnails served without their records are not
+# written with every access
+_recorded_accesses = OrderedDict()
+_recorded_accesses_lock = threading.Lock()
 
-    def delete_image_file(self):
+# the oldest recorded accesses are forgotten, when there is more of them
+RECORDED_ACCESSES_MAX = 10000
+
+
+class Thumbnail(models.Model):
+    """
+    Model that represents rendered thumbnail of the image. It is manifest of
+    the thumbnail files in the storage.
+    """
+    image = models.ForeignKey(
+        Image,
+        verbose_name=_('Image'),
+        help_text=_('Thumbnail of the image.'),
+        on_delete=models.CASCADE,
+    )
+
+    x_size = models.PositiveSmallIntegerField(
+        _('Requested width'),
+        help_text=_('Requested width. Zero, when it is calculated from height.'),
+    )
+
+    y_size = models.PositiveSmallIntegerField(
+        _('Requested height'),
+        help_text=_('Requested height. Zero, when it is calculated from width.'),
+    )
+
+    width = models.PositiveSmallIntegerField(
+        _('Width'),
+        help_text=_('Width of the rendered thumbnail.'),
+    )
+
+    height = models.PositiveSmallIntegerField(
+        _('Height'),
+        help_text=_('Height of the rendered thumbnail.'),
+    )
+
+    format = models.CharField(
+        _('Format'),
+        max_length=16,
+        help_text=_('Image format of the thumbnail (e.g. JPEG).'),
+    )
+
+    name = models.CharField(
+        _('Name'),
+        max_length=1024,
+        db_index=True,
+        help_text=_('Name of the thumbnail file in the storage.'),
+    )
+
+    bytes = models.PositiveIntegerField(
+        _('Bytes'),
+        help_text=_('Size of the thumbnail file.'),
+    )
+
+    created = models.DateTimeField(
+        _('Created'),
+        auto_now_add=True,
+        help_text=_('Timestamp of creation.'),
+    )
+
+    last_accessed = models.DateTimeField(
+        _('Last accessed'),
+        default=timezone.now,
+        help_text=_('Timestamp of last access. It is updated at most once '
+                    'per `THUMBNAIL_ACCESS_UPDATE_INTERVAL`.'),
+    )
+
+    class Meta:
+        verbose_name = _('Thumbnail')
+        verbose_name_plural = _('Thumbnails')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['image', 'x_size', 'y_size', 'format'],
+                name='unique_thumbnail_variant',
+            ),
+        ]
+        indexes = [
+            # eviction of least recently used thumbnails
+            models.Index(fields=['last_accessed', 'id']),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def touch(thumbnails):
         """
-        Deletes image file with all its thumbnails.
+        Updates `last_accessed` timestamp of the accessed `thumbnails`. To
+        avoid write with every access, only timestamps older than
+        `THUMBNAIL_ACCESS_UPDATE_INTERVAL` seconds are updated.
         """
-        basename = os.path.basename(self.file.name)
-        filename, extension = os.path.splitext(basename)
+        now = timezone.now()
+        threshold = now - timedelta(
+            seconds=app_settings.THUMBNAIL_ACCESS_UPDATE_INTERVAL)
 
-        thumbnail_directory = self._get_thumbnail_directory()
+        stale = [thumbnail.pk for thumbnail in thumbnails
+                 if thumbnail.last_accessed < threshold]
+        if stale:
+            Thumbnail.objects.filter(pk__in=stale).update(last_accessed=now)
 
-        # delete all the thumbnails
-        thumbnail_files = storage.listdir(thumbnail_directory)[1]
-        for thumb in thumbnail_files:
-            if thumb.startswith(filename):
-                storage.delete(os.path.join(thumbnail_directory, thumb))
+        Thumbnail.remember_accesses({
+            thumbnail.name: now if thumbnail.pk in stale
+            else thumbnail.last_accessed
+            for thumbnail in thumbnails
+        })
 
-        # delete image file
-        storage.delete(self.file.name)
+    @staticmethod
+    def touch_names(names):
+        """
+        Updates `last_accessed` timestamp of the thumbnails with `names`,
+        which were served without their records (from memory or with
+        `304 Not Modified`). Like `touch`, the timestamp is updated at most
+        once per `THUMBNAIL_ACCESS_UPDATE_INTERVAL` seconds by the process.
+        """
+        now = timezone.now()
+        threshold = now - timedelta(
+            seconds=app_settings.THUMBNAIL_ACCESS_UPDATE_INTERVAL)
+
+        with _recorded_accesses_lock:
+            stale = [name for name in names
+                     if name not in _recorded_accesses
+                     or _recorded_accesses[name] < threshold]
+        if not stale:
+            return
+
+        Thumbnail.objects.filter(name__in=stale, last_accessed__lt=threshold) \
+                         .update(last_accessed=now)
+        Thumbnail.remember_accesses({name: now for name in stale})
+
+    @staticmethod
+    def remember_accesses(accesses):
+        """
+        Remembers timestamps of the accesses recorded in database (dictionary
+        of `last_accessed` by the names of the thumbnails) for `touch_names`.
+        """
+        with _recorded_accesses_lock:
+            for name, last_accessed in accesses.items():
+                _recorded_accesses[name] = last_accessed
+                _recorded_accesses.move_to_end(name)
+
+            # the oldest accesses are forgotten first
+            while len(_recorded_accesses) > RECORDED_ACCESSES_MAX:
+                _recorded_accesses.popitem(last=False)
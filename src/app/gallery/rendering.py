@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import logging
+import mimetypes
+import os
+import multiprocessing
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image as PILImage, features
+from . import settings as app_settings
+from .executors import LazyExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+# worker processes are not forked from the threaded server
+_executor = LazyExecutor('THUMBNAIL_RENDER_PROCESSES',
+                         executor_class=ProcessPoolExecutor,
+                         mp_context=multiprocessing.get_context('spawn'))
+_queue_slots = threading.BoundedSemaphore(
+    app_settings.THUMBNAIL_RENDER_QUEUE_DEPTH)
+
+
+RenderedThumbnail = namedtuple('RenderedThumbnail',
+                               ['format', 'width', 'height', 'bytes'])
+
+# formats of thumbnails negotiated with `Accept` header, with their media
+# types and file extensions
+OUTPUT_FORMATS = {
+    'AVIF': ('image/avif', '.avif'),
+    'WEBP': ('image/webp', '.webp'),
+}
+
+for media_type, extension in OUTPUT_FORMATS.values():
+    mimetypes.add_type(media_type, extension)
+
+
+def get_output_formats():
+    """
+    Returns `THUMBNAIL_FORMATS`, which are supported by installed Pillow.
+    """
+    return [image_format for image_format in app_settings.THUMBNAIL_FORMATS
+            if image_format in OUTPUT_FORMATS
+            and features.check(image_format.lower())]
+
+
+class RenderingUnavailable(Exception):
+    """
+    Rendering process pool is full or it did not finish in time.
+    """
+    pass
+
+
+class RenderingTimeout(RenderingUnavailable):
+    """
+    Rendering did not finish in time. It can still go on in the process pool,
+    the `future` of the rendering tells, when it's finished.
+    """
+
+    def __init__(self, future):
+        super().__init__('Rendering timed out.')
+        self.future = future
+
+
+def get_executor():
+    """
+    Returns process pool for the thumbnail rendering. Pool is created with the
+    first rendering.
+    """
+    return _executor.get()
+
+
+def render(source_path, targets, image_format=None):
+    """
+    Renders thumbnails (see `render_thumbnails`) with the configured
+    `THUMBNAIL_RENDER_BACKEND`.
+
+    With the 'process' backend, rendering runs in the process pool and the
+    caller waits for the result at most `THUMBNAIL_RENDER_TIMEOUT` seconds.
+    When there are already `THUMBNAIL_RENDER_QUEUE_DEPTH` renderings in the
+    pool, `RenderingUnavailable` is raised immediately. When the rendering
+    does not finish in time, `RenderingTimeout` is raised; rendering, which
+    has not started yet, is cancelled.
+    """
+    if app_settings.THUMBNAIL_RENDER_BACKEND != 'process':
+        return render_thumbnails(source_path, targets, image_format)
+
+    if not _queue_slots.acquire(blocking=False):
+        raise RenderingUnavailable('Rendering queue is full.')
+
+    try:
+        future = get_executor().submit(render_thumbnails, source_path,
+                                       targets, image_format)
+    except BrokenProcessPool:
+        _queue_slots.release()
+        _reset_executor()
+        raise RenderingUnavailable('Rendering process pool is broken.')
+    except Exception:
+        _queue_slots.release()
+        raise
+
+    future.add_done_callback(lambda f: _queue_slots.release())
+
+    try:
+        return future.result(timeout=app_settings.THUMBNAIL_RENDER_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise RenderingTimeout(future)
+    except BrokenProcessPool:
+        _reset_executor()
+        raise RenderingUnavailable('Rendering process terminated.')
+
+
+def _reset_executor():
+    """
+    Drops broken process pool, the new one is created with the next
+    rendering.
+    """
+    _executor.shutdown(wait=False)
+
+
+def render_thumbnails(source_path, targets, image_format=None):
+    """
+    Renders several thumbnails of the image file `source_path` with one
+    decoding of the source image.
+
+    `targets` is list of `(dimensions, destination_path)` tuples, where
+    `dimensions` is `(width, height)` of the thumbnail or `None` for the
+    thumbnail in original size. Thumbnails are saved in `image_format` (e.g.
+    'WEBP') or in the format of the source image, with the
+    `THUMBNAIL_SAVE_OPTIONS` of the format.
+
+    JPEG images are decoded in the smallest DCT scale, which is still bigger
+    than the biggest requested thumbnail, and resizing uses `reducing_gap`, so
+    the big originals are not processed in full resolution. Thumbnails are
+    written to temporary files and atomically renamed.
+
+    Returns list of `RenderedThumbnail` tuples in the order of `targets`.
+    """
+    rendered = []
+    with PILImage.open(source_path) as image:
+        image_format = image_format or image.format
+        draft_size = (
+            max(dimensions[0] if dimensions else image.width
+                for dimensions, _ in targets),
+            max(dimensions[1] if dimensions else image.height
+                for dimensions, _ in targets),
+        )
+
+        # no-op for the other formats than JPEG
+        image.draft(image.mode, draft_size)
+
+        for dimensions, destination_path in targets:
+            if dimensions is None or dimensions == image.size:
+                thumbnail = image
+            else:
+                thumbnail = image.resize(
+                    dimensions,
+                    reducing_gap=app_settings.THUMBNAIL_REDUCING_GAP,
+                )
+
+            _save_atomically(thumbnail, destination_path, image_format)
+            rendered.append(RenderedThumbnail(
+                image_format, thumbnail.width, thumbnail.height,
+                os.path.getsize(destination_path)))
+
+    return rendered
+
+
+def _save_atomically(pil_image, destination_path, image_format):
+    """
+    Saves Pillow image to temporary file in the destination directory and
+    renames it to `destination_path`, so nobody can read partially written
+    file.
+    """
+    directory, basename = os.path.split(destination_path)
+
+    fd, temporary_path = tempfile.mkstemp(dir=directory,
+                                          prefix='.{}.'.format(basename))
+    os.close(fd)
+
+    try:
+        pil_image.save(temporary_path, format=image_format,
+                       **app_settings.THUMBNAIL_SAVE_OPTIONS.get(image_format, {}))
+        os.replace(temporary_path, destination_path)
+    except Exception:
+        os.remove(temporary_path)
+        raise
@@ -5,6 +5,12 @@ GALLERIES_SUBDIRECTORY = getattr(settings, 'GALLERIES_SUBDIRECTORY', 'galleries'
 
 THUMBNAILS_SUBDIRECTORY = getattr(settings, 'THUMBNAILS_SUBDIRECTORY', 'thumbnails')
 
+# directories of deleted galleries waiting for removal, relative to `MEDIA_ROOT`
+TRASH_SUBDIRECTORY = getattr(settings, 'TRASH_SUBDIRECTORY', 'trash')
+
+# lock files of the thumbnail rendering, relative to `MEDIA_ROOT`
+LOCKS_SUBDIRECTORY = getattr(settings, 'LOCKS_SUBDIRECTORY', 'locks')
+
 FACEBOOK_AUTHORIZATION_BASE_URL = getattr(
     settings,
     'FACEBOOK_AUTHORIZATION_BASE_URL',
@@ -22,3 +28,138 @@ FACEBOOK_GRAPH_API_ME_URL = getattr(
     'FACEBOOK_GRAPH_API_ME_URL',
     'https://graph.facebook.com/me?'
 )
+
+# byte budget of the in-process cache of rendered thumbnails, zero disables it
+THUMBNAIL_CACHE_MAX_BYTES = getattr(settings, 'THUMBNAIL_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+# thumbnail sizes, which are rendered in background right after image upload,
+# e.g. ((200, 200), (0, 600))
+THUMBNAIL_PRERENDER_SIZES = getattr(settings, 'THUMBNAIL_PRERENDER_SIZES', ())
+
+# number of background threads rendering thumbnails of uploaded images
+THUMBNAIL_PRERENDER_WORKERS = getattr(settings, 'THUMBNAIL_PRERENDER_WORKERS', 2)
+
+# Pillow `reducing_gap` for thumbnail resizing, `None` disables reducing
+THUMBNAIL_REDUCING_GAP = getattr(settings, 'THUMBNAIL_REDUCING_GAP', 3.0)
+
+# number of lock files shared by all the thumbnails, thumbnails with the
+# same lock file are not rendered at the same time
+THUMBNAIL_LOCK_FILES = getattr(settings, 'THUMBNAIL_LOCK_FILES', 256)
+
+# where thumbnails are rendered: 'inline' in the request thread or 'process'
+# in the pool of worker processes
+THUMBNAIL_RENDER_BACKEND = getattr(settings, 'THUMBNAIL_RENDER_BACKEND', 'inline')
+
+# number of worker processes of the 'process' rendering backend
+THUMBNAIL_RENDER_PROCESSES = getattr(settings, 'THUMBNAIL_RENDER_PROCESSES', None)
+
+# maximal number of renderings waiting or running in the process pool
+THUMBNAIL_RENDER_QUEUE_DEPTH = getattr(settings, 'THUMBNAIL_RENDER_QUEUE_DEPTH', 32)
+
+# seconds to wait for rendering in the process pool
+THUMBNAIL_RENDER_TIMEOUT = getattr(settings, 'THUMBNAIL_RENDER_TIMEOUT', 30)
+
+# which thumbnail sizes are rendered: 'any' size, sizes from the
+# `THUMBNAIL_SIZES` 'allowlist', size snapped to the nearest of
+# `THUMBNAIL_SIZES` ('snap') or 'redirect' to URL of the nearest size
+THUMBNAIL_SIZE_POLICY = getattr(settings, 'THUMBNAIL_SIZE_POLICY', 'any')
+
+# thumbnail sizes of the 'allowlist', 'snap' and 'redirect' size policies,
+# e.g. ((200, 200), (0, 600))
+THUMBNAIL_SIZES = getattr(settings, 'THUMBNAIL_SIZES', ())
+
+# maximal width and height of the thumbnail, `None` disables the limit
+THUMBNAIL_MAX_SIZE = getattr(settings, 'THUMBNAIL_MAX_SIZE', 4096)
+
+# formats of thumbnails negotiated with `Accept` header in order of
+# preference, thumbnail has format of the original image otherwise
+THUMBNAIL_FORMATS = getattr(settings, 'THUMBNAIL_FORMATS', ('AVIF', 'WEBP'))
+
+# Pillow save options of the thumbnails by their format
+THUMBNAIL_SAVE_OPTIONS = getattr(settings, 'THUMBNAIL_SAVE_OPTIONS', {
+    'JPEG': {'quality': 80, 'optimize': True},
+    'WEBP': {'quality': 80, 'method': 4},
+    'AVIF': {'quality': 60, 'speed': 8},
+})
+
+# seconds, after which `last_accessed` timestamp of the accessed thumbnail
+# is updated in database
+THUMBNAIL_ACCESS_UPDATE_INTERVAL = getattr(settings, 'THUMBNAIL_ACCESS_UPDATE_INTERVAL', 60 * 60)
+
+# byte quota of the rendered thumbnails, least recently used thumbnails
+# above it are evicted (see `evict_thumbnails` command), `None` disables it
+THUMBNAIL_QUOTA_BYTES = getattr(settings, 'THUMBNAIL_QUOTA_BYTES', None)
+
+# seconds between evictions of thumbnails in background thread of each
+# worker process, `None` leaves eviction to the `evict_thumbnails` command
+THUMBNAIL_EVICTION_INTERVAL = getattr(settings, 'THUMBNAIL_EVICTION_INTERVAL', None)
+
+# maximal page size of the opt-in cursor pagination (`?limit=` parameter)
+PAGINATION_MAX_LIMIT = getattr(settings, 'PAGINATION_MAX_LIMIT', 1000)
+
+# number of images fetched from database at once in streaming responses
+STREAMING_CHUNK_SIZE = getattr(settings, 'STREAMING_CHUNK_SIZE', 500)
+
+# number of threads reading files of the image and thumbnail responses sent
+# by `GalleryASGIHandler`, they are shared by all the downloads
+FILE_READ_WORKERS = getattr(settings, 'FILE_READ_WORKERS', 8)
+
+# `Cache-Control` directives of the thumbnail responses
+THUMBNAIL_CACHE_CONTROL = getattr(settings, 'THUMBNAIL_CACHE_CONTROL', {
+    'public': True,
+    'max_age': 24 * 60 * 60,
+})
+
+# how image files are sent: 'direct' by Django, 'x-accel-redirect' by nginx
+# or 'x-sendfile' by Apache or lighttpd
+IMAGE_DELIVERY_BACKEND = getattr(settings, 'IMAGE_DELIVERY_BACKEND', 'direct')
+
+# prefix of the nginx internal location, which serves `MEDIA_ROOT`
+IMAGE_DELIVERY_ACCEL_PREFIX = getattr(settings, 'IMAGE_DELIVERY_ACCEL_PREFIX', '/protected/')
+
+# alias of the cache (in `CACHES`) for the results of Facebook token
+# verification, local memory cache is used when it is not configured
+FACEBOOK_TOKEN_CACHE = getattr(settings, 'FACEBOOK_TOKEN_CACHE', 'default')
+
+# seconds to cache verified Facebook tokens
+FACEBOOK_TOKEN_CACHE_TTL = getattr(settings, 'FACEBOOK_TOKEN_CACHE_TTL', 5 * 60)
+
+# seconds to cache Facebook tokens refused by Facebook Graph API
+FACEBOOK_TOKEN_CACHE_NEGATIVE_TTL = getattr(settings, 'FACEBOOK_TOKEN_CACHE_NEGATIVE_TTL', 30)
+
+# maximal number of kept-alive connections to Facebook Graph API
+FACEBOOK_GRAPH_POOL_SIZE = getattr(settings, 'FACEBOOK_GRAPH_POOL_SIZE', 10)
+
+# seconds to wait for connection to Facebook Graph API and for its response
+FACEBOOK_GRAPH_CONNECT_TIMEOUT = getattr(settings, 'FACEBOOK_GRAPH_CONNECT_TIMEOUT', 3.05)
+FACEBOOK_GRAPH_READ_TIMEOUT = getattr(settings, 'FACEBOOK_GRAPH_READ_TIMEOUT', 10)
+
+# retries of failed requests to Facebook Graph API with exponential backoff
+FACEBOOK_GRAPH_RETRIES = getattr(settings, 'FACEBOOK_GRAPH_RETRIES', 2)
+FACEBOOK_GRAPH_RETRY_BACKOFF = getattr(settings, 'FACEBOOK_GRAPH_RETRY_BACKOFF', 0.3)
+
+# after this number of consecutive failures, Facebook Graph API is not called
+# for `FACEBOOK_GRAPH_BREAKER_RESET_TIMEOUT` seconds
+FACEBOOK_GRAPH_BREAKER_THRESHOLD = getattr(settings, 'FACEBOOK_GRAPH_BREAKER_THRESHOLD', 5)
+FACEBOOK_GRAPH_BREAKER_RESET_TIMEOUT = getattr(settings, 'FACEBOOK_GRAPH_BREAKER_RESET_TIMEOUT', 30)
+
+# maximal number of files and bytes of files in one upload request
+UPLOAD_MAX_FILES = getattr(settings, 'UPLOAD_MAX_FILES', 50)
+UPLOAD_MAX_BYTES = getattr(settings, 'UPLOAD_MAX_BYTES', 200 * 1024 * 1024)
+
+# number of threads validating and storing uploaded images
+UPLOAD_WORKERS = getattr(settings, 'UPLOAD_WORKERS', 4)
+
+# alias of the cache (in `CACHES`) for the images resolved from their URL,
+# local memory cache is used when it is not configured; cache shared by all
+# the worker processes (e.g. memcached) is needed to see changes of the
+# images immediately
+IMAGE_LOOKUP_CACHE = getattr(settings, 'IMAGE_LOOKUP_CACHE', 'default')
+
+# seconds to cache images resolved from their URL, zero disables the cache;
+# enable it only with the shared `IMAGE_LOOKUP_CACHE`, otherwise the other
+# worker processes serve changed and deleted images until it expires
+IMAGE_LOOKUP_CACHE_TTL = getattr(settings, 'IMAGE_LOOKUP_CACHE_TTL', 0)
+
+# directory of deleted gallery is moved to the trash and removed in background
+GALLERY_DELETE_IN_BACKGROUND = getattr(settings, 'GALLERY_DELETE_IN_BACKGROUND', False)
@@ -3,11 +3,19 @@ import logging
 import os
 import shutil
 from django.core.files.storage import get_storage_class
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Concat
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.utils.text import slugify
-from .models import Gallery, Image
+from .cache import invalidate_images, invalidate_thumbnail, thumbnail_cache
+from .models import Gallery, Image, Thumbnail, storage
 from . import settings as app_settings
+from .tasks import (
+    delete_directory_in_background, prerender_thumbnails, start_eviction_sweep
+)
 
 
 logger = logging.getLogger(__name__)
@@ -22,27 +30,88 @@ def gallery_presave(sender, instance, *args, **kwargs):
         instance.path = slugify(instance.name)
 
 
+@receiver(post_save, sender=Gallery)
+def gallery_postsave(sender, instance, created, *args, **kwargs):
+    # thumbnails are cached under the gallery name and the previous name of
+    # renamed gallery is not known here
+    if not created:
+        thumbnail_cache.clear()
+
+        # fullpath of the images is derived from the gallery name
+        invalidate_images(instance.image_set.values_list('fullpath', flat=True))
+        instance.image_set.update(
+            fullpath=Concat(Value('{}/'.format(instance.path)), 'path'))
+
+
 @receiver(post_delete, sender=Gallery)
-def gallery_postdelete(sender, instance, *args, **kwargs):
-    logger.debug('Delete gallery directory: {}/{}'.format(
-                 app_settings.GALLERIES_SUBDIRECTORY,
-                 instance.path))
-    try:
-        instance.delete_gallery_directory()
-    except Exception as e:
-        logger.error(e)
+def gallery_postdelete(sender, instance, using, *args, **kwargs):
+    thumbnail_cache.invalidate(instance.name)
+
+    def delete_directory():
+        logger.debug('Delete gallery directory: {}/{}'.format(
+                     app_settings.GALLERIES_SUBDIRECTORY,
+                     instance.path))
+        try:
+            if app_settings.GALLERY_DELETE_IN_BACKGROUND:
+                delete_directory_in_background(instance.get_gallery_directory())
+            else:
+                instance.delete_gallery_directory()
+        except Exception as e:
+            logger.error(e)
+
+    # files are kept, when the deletion is rolled back
+    transaction.on_commit(delete_directory, using=using)
+
+
+@receiver(pre_save, sender=Image)
+def image_presave(sender, instance, *args, **kwargs):
+    # store new file before insert, so its final name is known and the image
+    # is written only once
+    if instance.file and not instance.file._committed:
+        instance.store_file()
+
+    if instance.file:
+        instance.path = os.path.basename(instance.file.name)
+        instance.fullpath = Image.get_fullpath(instance.gallery.path,
+                                               instance.path)
 
 
 @receiver(post_save, sender=Image)
 def image_postsave(sender, instance, created, *args, **kwargs):
     if created:
-        instance.path = os.path.basename(instance.file.name)
-        instance.save(update_fields=['path'])
+        # render thumbnails once the image is visible to the other connections
+        transaction.on_commit(lambda: prerender_thumbnails(instance.pk))
+
+    invalidate_images([instance.fullpath])
+    thumbnail_cache.invalidate(instance.gallery.name, instance.path)
 
 
 @receiver(post_delete, sender=Image)
 def image_postdelete(sender, instance, *args, **kwargs):
+    invalidate_images([instance.fullpath])
+    thumbnail_cache.invalidate(instance.gallery.name, instance.path)
     try:
         instance.delete_image_file()
     except Exception as e:
         logger.error(e)
+
+
+@receiver(post_delete, sender=Thumbnail)
+def thumbnail_postdelete(sender, instance, *args, **kwargs):
+    # only files in thumbnail directories are deleted, never the originals
+    directory = os.path.basename(os.path.dirname(instance.name))
+    if directory != app_settings.THUMBNAILS_SUBDIRECTORY:
+        logger.error('Thumbnail outside of thumbnail directory: {}'.format(
+                     instance.name))
+        return
+
+    invalidate_thumbnail(instance.image_id, instance.name)
+    try:
+        storage.delete(instance.name)
+    except Exception as e:
+        logger.error(e)
+
+
+@receiver(request_started)
+def start_thumbnail_eviction(sender, *args, **kwargs):
+    start_eviction_sweep()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from django.db import connection
+from django.db.models import Sum
+from .models import Image, Thumbnail, storage
+from . import settings as app_settings
+from .executors import LazyExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+_executor = LazyExecutor('THUMBNAIL_PRERENDER_WORKERS', 'gallery')
+
+_sweep = None
+_sweep_lock = threading.Lock()
+
+# number of thumbnails deleted with one query
+EVICTION_BATCH_SIZE = 500
+
+
+def get_executor():
+    """
+    Returns thread pool for the background jobs. Pool is created with the
+    first job.
+    """
+    return _executor.get()
+
+
+def prerender_thumbnails(image_pk):
+    """
+    Schedules rendering of all the `THUMBNAIL_PRERENDER_SIZES` thumbnails of
+    the image with primary key `image_pk`.
+    """
+    if not app_settings.THUMBNAIL_PRERENDER_SIZES:
+        return None
+
+    return get_executor().submit(_prerender_thumbnails, image_pk)
+
+
+def _prerender_thumbnails(image_pk):
+    try:
+        image = Image.objects.get(pk=image_pk)
+        image.render_thumbnails(app_settings.THUMBNAIL_PRERENDER_SIZES)
+    except Exception as e:
+        logger.error(e)
+    finally:
+        # worker threads are not managed by request cycle
+        connection.close()
+
+
+def get_trash_directory():
+    """
+    Returns absolute path to the directory of the directories waiting for
+    removal.
+    """
+    return os.path.join(storage.location, app_settings.TRASH_SUBDIRECTORY)
+
+
+def delete_directory_in_background(path):
+    """
+    Moves directory with absolute `path` to the trash and schedules emptying
+    of the trash. Moving is one `rename`, so it does not depend on the number
+    of files in the directory.
+    """
+    trash = get_trash_directory()
+    os.makedirs(trash, exist_ok=True)
+    os.rename(path, os.path.join(trash, uuid.uuid4().hex))
+
+    return get_executor().submit(empty_trash)
+
+
+def empty_trash():
+    """
+    Removes all the directories in the trash, including directories left
+    there by the other or terminated processes.
+    """
+    trash = get_trash_directory()
+    if not os.path.isdir(trash):
+        return
+
+    for name in os.listdir(trash):
+        shutil.rmtree(os.path.join(trash, name), ignore_errors=True)
+
+
+def evict_thumbnails(quota=None):
+    """
+    Deletes least recently used thumbnails, until all the thumbnails fit to
+    `quota` bytes (`THUMBNAIL_QUOTA_BYTES` by default). Only thumbnails
+    recorded in the `Thumbnail` manifest are deleted, original images are
+    never touched.
+
+    Returns tuple of the number of deleted thumbnails and freed bytes.
+    """
+    if quota is None:
+        quota = app_settings.THUMBNAIL_QUOTA_BYTES
+    if quota is None:
+        return 0, 0
+
+    total = Thumbnail.objects.aggregate(total=Sum('bytes'))['total'] or 0
+    if total <= quota:
+        return 0, 0
+
+    evicted = []
+    freed = 0
+    thumbnails = Thumbnail.objects.order_by('last_accessed', 'pk') \
+                                  .values_list('pk', 'bytes')
+    for pk, size in thumbnails.iterator():
+        if total - freed <= quota:
+            break
+        evicted.append(pk)
+        freed += size
+
+    # files are deleted by `post_delete` signal of the thumbnails
+    for i in range(0, len(evicted), EVICTION_BATCH_SIZE):
+        Thumbnail.objects.filter(
+            pk__in=evicted[i:i + EVICTION_BATCH_SIZE]).delete()
+
+    logger.info('Evicted {} thumbnails, {} bytes freed.'.format(
+        len(evicted), freed))
+    return len(evicted), freed
+
+
+def start_eviction_sweep():
+    """
+    Starts background thread, which evicts thumbnails every
+    `THUMBNAIL_EVICTION_INTERVAL` seconds. It is started at most once in the
+    process.
+    """
+    global _sweep
+
+    if not app_settings.THUMBNAIL_EVICTION_INTERVAL or _sweep is not None:
+        return
+
+    with _sweep_lock:
+        if _sweep is None:
+            _sweep = threading.Thread(target=_sweep_thumbnails,
+                                      name='gallery-eviction', daemon=True)
+            _sweep.start()
+
+
+def _sweep_thumbnails():
+    while True:
+        time.sleep(app_settings.THUMBNAIL_EVICTION_INTERVAL)
+        try:
+            evict_thumbnails()
+        except Exception as e:
+            logger.error(e)
+        finally:
+            # sweep thread is not managed by request cycle
+            connection.close()
@@ -1,3 +1,1506 @@
-from django.test import TestCase
+import asyncio
+import fcntl
+import importlib
+import inspect
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from django.apps import apps
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import (
+    SimpleTestCase, TestCase, TransactionTestCase, override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import exceptions
+from PIL import Image as PILImage
+from PIL.JpegImagePlugin import JpegImageFile
+from app.db_routers import ReplicaRouter
+from . import models, rendering, settings as app_settings, signals, tasks
+from .api import graph, uploads
+from .api.exceptions import ServiceUnavailable
+from .api.responses import parse_range_header
+from .api.views import get_image
+from .api.simple_fb_auth import (
+    SimpleFacebookAuthentication, get_token_cache, invalidate_token
+)
+from .cache import (
+    CachedThumbnail, ThumbnailCache, cache_image, get_cached_image,
+    get_lookup_cache, thumbnail_cache
+)
+from .executors import LazyExecutor
+from .forms import ImageForm
+from .handlers import GalleryASGIHandler
+from .locks import LockTimeout, file_lock
+from .models import (
+    Gallery, Image, Thumbnail, get_thumbnail_lock_path, storage
+)
+from .tasks import empty_trash, evict_thumbnails, get_trash_directory
 
-# Create your tests here.
+
+def create_gallery(name, images=1):
+    """
+    Creates gallery with `images` number of images. Images are not stored in
+    the filesystem, they have only name of the file.
+    """
+    gallery = Gallery.objects.create(name=name)
+    for i in range(images):
+        Image.objects.create(
+            gallery=gallery,
+            file='galleries/{}/image-{}.jpg'.format(gallery.path, i),
+            name='Image {}'.format(i),
+            width=800,
+            height=600,
+        )
+    return gallery
+
+
+def create_image_file(name='image.jpg', size=(800, 600)):
+    """
+    Returns uploaded JPEG file of the `size`.
+    """
+    content = io.BytesIO()
+    PILImage.new('RGB', size, 'red').save(content, 'JPEG')
+    return SimpleUploadedFile(name, content.getvalue())
+
+
+def create_image(gallery, name='image.jpg', size=(800, 600)):
+    """
+    Creates image of the `size` stored in the filesystem.
+    """
+    image = Image(gallery=gallery, name=name,
+                  file=create_image_file(name, size))
+    image.save()
+    return image
+
+
+class MediaTestMixin:
+    """
+    Mixin for test cases with images stored in temporary `MEDIA_ROOT`.
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        thumbnail_cache.clear()
+        self.addCleanup(thumbnail_cache.clear)
+
+        get_lookup_cache().clear()
+        self.addCleanup(get_lookup_cache().clear)
+
+
+class MediaTestCase(MediaTestMixin, TestCase):
+    pass
+
+
+class GalleryQueriesTestCase(TestCase):
+
+    def test_gallery_list_queries(self):
+        for i in range(3):
+            create_gallery('Gallery {}'.format(i))
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/gallery/')
+        self.assertEqual(len(response.json()), 3)
+
+        for i in range(3, 10):
+            create_gallery('Gallery {}'.format(i), images=3)
+        Gallery.objects.create(name='Empty')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/gallery/')
+
+        galleries = {gallery['name']: gallery for gallery in response.json()}
+        self.assertEqual(len(galleries), 11)
+        self.assertNotIn('image', galleries['Empty'])
+        self.assertEqual(galleries['Gallery 5']['image']['fullpath'],
+                         'Gallery%205/image-0.jpg')
+
+    def test_gallery_detail_queries(self):
+        create_gallery('Small', images=2)
+        create_gallery('Big', images=20)
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/gallery/Small')
+        self.assertEqual(len(response.json()['images']), 2)
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/gallery/Big')
+        self.assertEqual(len(response.json()['images']), 20)
+        self.assertEqual(response.json()['images'][0]['fullpath'],
+                         'Big/image-0.jpg')
+
+
+class ImageLookupTestCase(TestCase):
+
+    def test_image_is_selected_by_fullpath(self):
+        create_gallery('My Gallery', images=2)
+
+        with CaptureQueriesContext(connection) as queries:
+            image = get_image('My Gallery', 'image-1.jpg')
+
+        self.assertEqual(image.fullpath, 'My%20Gallery/image-1.jpg')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('JOIN', queries[0]['sql'])
+
+        with self.assertRaises(exceptions.NotFound):
+            get_image('My', 'image-1.jpg')
+
+    def test_gallery_rename(self):
+        gallery = create_gallery('Old', images=2)
+        gallery.name = 'New Name'
+        gallery.save()
+
+        self.assertEqual(
+            sorted(Image.objects.values_list('fullpath', flat=True)),
+            ['New%20Name/image-0.jpg', 'New%20Name/image-1.jpg'])
+        self.assertEqual(get_image('New Name', 'image-0.jpg').name, 'Image 0')
+
+
+class PaginationTestCase(TestCase):
+
+    def test_gallery_list_pagination(self):
+        for i in range(5):
+            create_gallery('Gallery {}'.format(i))
+
+        names = []
+        url = '/gallery/?limit=2'
+        while url:
+            response = self.client.get(url)
+            names += [gallery['name'] for gallery in response.json()['results']]
+            url = response.json()['next']
+
+        self.assertEqual(names, ['Gallery {}'.format(i) for i in range(5)])
+
+    def test_gallery_detail_pagination(self):
+        create_gallery('Gallery', images=5)
+
+        response = self.client.get('/gallery/Gallery?limit=3')
+        self.assertEqual(len(response.json()['images']), 3)
+        self.assertIsNone(response.json()['previous'])
+
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([image['path'] for image in response.json()['images']],
+                         ['image-3.jpg', 'image-4.jpg'])
+        self.assertIsNone(response.json()['next'])
+
+    def test_pagination_is_opt_in(self):
+        create_gallery('Gallery', images=5)
+
+        self.assertEqual(len(self.client.get('/gallery/').json()), 1)
+        self.assertEqual(len(self.client.get('/gallery/Gallery').json()['images']), 5)
+
+
+class StreamingTestCase(TestCase):
+
+    def test_gallery_detail_stream(self):
+        create_gallery('My Gallery', images=3)
+        expected = self.client.get('/gallery/My Gallery').json()
+
+        response = self.client.get('/gallery/My Gallery?stream=1')
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(b''.join(response.streaming_content)),
+                         expected)
+
+    def test_gallery_detail_ndjson(self):
+        create_gallery('My Gallery', images=3)
+        expected = self.client.get('/gallery/My Gallery').json()['images']
+
+        response = self.client.get('/gallery/My Gallery',
+                                   HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+    def test_empty_gallery_stream(self):
+        Gallery.objects.create(name='Empty')
+
+        response = self.client.get('/gallery/Empty?stream=1')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)),
+                         {'path': 'Empty', 'name': 'Empty', 'images': []})
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTestCase(TestCase):
+    """
+    Replica is not configured in tests, so the `default` database stands in
+    for it and the router is asked, where the reads would go.
+    """
+
+    def setUp(self):
+        create_gallery('My Gallery', images=3)
+
+        self.reads = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def record_read(router, model, **hints):
+            self.reads.append(db_for_read(router, model, **hints))
+            return 'default'
+
+        patcher = mock.patch.object(ReplicaRouter, 'db_for_read', autospec=True,
+                                    side_effect=record_read)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_views_read_from_replicas(self):
+        self.client.get('/gallery/')
+        self.client.get('/gallery/My Gallery?limit=2')
+        self.assertTrue(self.reads)
+        self.assertEqual(set(self.reads), {'replica'})
+
+    def test_streaming_reads_from_replicas(self):
+        response = self.client.get('/gallery/My Gallery?stream=1')
+        self.reads.clear()
+        self.assertEqual(
+            len(json.loads(b''.join(response.streaming_content))['images']), 3)
+        self.assertEqual(set(self.reads), {'replica'})
+
+    def test_writes_read_from_primary(self):
+        self.client.post('/gallery/', {'name': 'New Gallery'})
+        self.assertTrue(self.reads)
+        self.assertEqual(set(self.reads), {'default'})
+        self.assertEqual(ReplicaRouter().db_for_write(Gallery), 'default')
+
+    def test_replicas_are_not_migrated(self):
+        router = ReplicaRouter()
+        self.assertFalse(router.allow_migrate('replica', 'gallery'))
+        self.assertTrue(router.allow_migrate('default', 'gallery'))
+
+
+class ConditionalRequestsTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+
+    def test_image_detail_not_modified(self):
+        response = self.client.get('/gallery/My Gallery/image.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get('/gallery/My Gallery/image.jpg',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/gallery/My Gallery/image.jpg',
+                                   HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_image_preview_not_modified(self):
+        url = '/images/200x0/My Gallery/image.jpg/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age', response['Cache-Control'])
+        etag = response['ETag']
+
+        # served from the in-memory cache
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # served from the storage
+        thumbnail_cache.clear()
+        response = self.client.get(url,
+                                   HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/images/100x0/My Gallery/image.jpg/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class ThumbnailCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ThumbnailCache(max_bytes=10)
+        self.modified = timezone.now()
+
+    def set(self, image_path, size, x_size=200):
+        key = ThumbnailCache.get_key('Gallery', image_path, x_size, 0)
+        self.cache.set(key, CachedThumbnail(self.modified, '"etag"',
+                                            'image/jpeg', b'x' * size))
+        return key
+
+    def test_get(self):
+        key = self.set('first.jpg', 4)
+
+        self.assertEqual(self.cache.get(key, self.modified).content, b'xxxx')
+        self.assertIsNone(self.cache.get(
+            ThumbnailCache.get_key('Gallery', 'other.jpg', 200, 0),
+            self.modified))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # entry of other version of the image is dropped
+        self.assertIsNone(self.cache.get(key, self.modified - timedelta(1)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+    def test_least_recently_used_are_evicted(self):
+        first = self.set('first.jpg', 4)
+        second = self.set('second.jpg', 4)
+        self.cache.get(first, self.modified)
+
+        third = self.set('third.jpg', 4)
+        self.assertIsNone(self.cache.get(second, self.modified))
+        self.assertIsNotNone(self.cache.get(first, self.modified))
+        self.assertIsNotNone(self.cache.get(third, self.modified))
+        self.assertEqual(self.cache.size, 8)
+
+    def test_replaced_entry(self):
+        key = self.set('first.jpg', 4)
+        self.set('first.jpg', 6)
+        self.assertEqual((len(self.cache), self.cache.size), (1, 6))
+        self.assertEqual(len(self.cache.get(key, self.modified).content), 6)
+
+    def test_entry_bigger_than_budget(self):
+        self.set('first.jpg', 4)
+        key = self.set('big.jpg', 11)
+
+        self.assertIsNone(self.cache.get(key, self.modified))
+        self.assertEqual((len(self.cache), self.cache.size), (1, 4))
+
+    def test_invalidate(self):
+        first = self.set('first.jpg', 2)
+        other_size = self.set('first.jpg', 2, x_size=100)
+        second = self.set('second.jpg', 2)
+
+        self.cache.invalidate('Gallery', 'first.jpg')
+        self.assertIsNone(self.cache.get(first, self.modified))
+        self.assertIsNone(self.cache.get(other_size, self.modified))
+        self.assertIsNotNone(self.cache.get(second, self.modified))
+        self.assertEqual(self.cache.size, 2)
+
+        self.cache.invalidate('Other')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.invalidate('Gallery')
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+
+@mock.patch.object(app_settings, 'IMAGE_LOOKUP_CACHE_TTL', 5 * 60)
+class ImageLookupCacheTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+
+    def test_cached_image_detail(self):
+        url = '/gallery/My Gallery/image.jpg'
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['ETag'], etag)
+        with self.image.file.open('rb') as image_file:
+            self.assertEqual(b''.join(response.streaming_content),
+                             image_file.read())
+
+    @mock.patch.object(app_settings, 'IMAGE_LOOKUP_CACHE', 'missing')
+    @mock.patch.object(app_settings, 'FACEBOOK_TOKEN_CACHE', 'missing')
+    def test_local_cache(self):
+        # caches not configured in `CACHES` are local to the process
+        cache = get_lookup_cache()
+        self.assertIsInstance(cache, LocMemCache)
+        self.assertIs(get_lookup_cache(), cache)
+        self.assertIsInstance(get_token_cache(), LocMemCache)
+        self.assertIsNot(get_token_cache(), cache)
+
+    def test_cached_image_preview(self):
+        self.client.get('/images/200x0/My Gallery/image.jpg/')
+        thumbnail_cache.clear()
+
+        # image and its thumbnail in the manifest are cached
+        with self.assertNumQueries(0):
+            response = self.client.get('/images/200x0/My Gallery/image.jpg/')
+        self.assertEqual(response.status_code, 200)
+
+        # new thumbnail is looked up and recorded in the manifest
+        with self.assertNumQueries(3):
+            response = self.client.get('/images/100x0/My Gallery/image.jpg/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_evicted_thumbnail(self):
+        url = '/images/200x0/My Gallery/image.jpg/'
+        self.client.get(url)
+        thumbnail_cache.clear()
+
+        evict_thumbnails(quota=0)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Thumbnail.objects.exists())
+
+    def test_invalidation(self):
+        url = '/gallery/My Gallery/image.jpg'
+        etag = self.client.get(url)['ETag']
+
+        self.image.name = 'Renamed'
+        self.image.save()
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_missing_file(self):
+        url = '/gallery/My Gallery/image.jpg'
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # image deleted by the other worker process is still cached here
+        storage.delete(self.image.file.name)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertIsNone(get_cached_image(self.image.fullpath))
+
+        cache_image(self.image)
+        response = self.client.get('/images/200x0/My Gallery/image.jpg/')
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(get_cached_image(self.image.fullpath))
+
+    def test_cached_preview_of_changed_image(self):
+        url = '/images/200x0/My Gallery/image.jpg/'
+        etag = self.client.get(url)['ETag']
+
+        # signals of the other worker processes do not reach in-process cache
+        with mock.patch.object(thumbnail_cache, 'invalidate'):
+            self.image.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+            self.image.delete()
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class GalleryDeletionTestCase(MediaTestMixin, TransactionTestCase):
+    """
+    Gallery directory is deleted once the deletion is committed.
+    """
+
+    def create_gallery(self, name, images):
+        gallery = Gallery.objects.create(name=name)
+        for i in range(images):
+            image = create_image(gallery, 'image-{}.jpg'.format(i))
+            image.render_thumbnail(200, 0)
+        return gallery
+
+    def test_number_of_queries(self):
+        small = self.create_gallery('Small', images=1)
+        big = self.create_gallery('Big', images=5)
+
+        with CaptureQueriesContext(connection) as queries:
+            small.delete()
+
+        with self.assertNumQueries(len(queries)):
+            big.delete()
+
+        self.assertFalse(Image.objects.exists())
+        self.assertFalse(os.path.exists(big.get_gallery_directory()))
+
+    def test_queryset_delete(self):
+        small = self.create_gallery('Small', images=1)
+        big = self.create_gallery('Big', images=5)
+
+        # admin "delete selected" action deletes the queryset
+        with CaptureQueriesContext(connection) as queries:
+            Gallery.objects.filter(pk=small.pk).delete()
+
+        with self.assertNumQueries(len(queries)):
+            count, rows = Gallery.objects.filter(pk=big.pk).delete()
+
+        self.assertEqual(count, 11)
+        self.assertEqual(rows, {'gallery.Gallery': 1, 'gallery.Image': 5,
+                                'gallery.Thumbnail': 5})
+        self.assertFalse(os.path.exists(big.get_gallery_directory()))
+
+    def test_raw_delete_signature(self):
+        # `raw_delete` relies on private Django API
+        self.assertEqual(
+            list(inspect.signature(QuerySet._raw_delete).parameters),
+            ['self', 'using'])
+
+    def test_no_lookup_cache(self):
+        gallery = self.create_gallery('My Gallery', images=2)
+
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch('app.gallery.cache.invalidate_images') as invalidate:
+            gallery.delete()
+
+        self.assertFalse([query for query in queries if query['sql'].startswith(
+            'SELECT "gallery_image"."fullpath"')])
+        invalidate.assert_not_called()
+
+    def test_rollback(self):
+        gallery = self.create_gallery('My Gallery', images=1)
+
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            gallery.delete()
+            raise RuntimeError
+
+        self.assertTrue(Image.objects.exists())
+        self.assertTrue(os.path.exists(gallery.get_gallery_directory()))
+
+    @mock.patch.object(app_settings, 'IMAGE_LOOKUP_CACHE_TTL', 300)
+    def test_cached_images_are_invalidated(self):
+        gallery = self.create_gallery('My Gallery', images=1)
+        url = '/gallery/My Gallery/image-0.jpg'
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        gallery.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    @mock.patch.object(app_settings, 'GALLERY_DELETE_IN_BACKGROUND', True)
+    def test_delete_in_background(self):
+        gallery = self.create_gallery('My Gallery', images=2)
+        gallery.delete()
+
+        self.assertFalse(os.path.exists(gallery.get_gallery_directory()))
+
+        empty_trash()
+        self.assertEqual(os.listdir(get_trash_directory()), [])
+
+
+class ThumbnailManifestTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.gallery = Gallery.objects.create(name='My Gallery')
+        self.image = create_image(self.gallery, 'photo.jpg')
+
+    def test_rendered_thumbnail_is_recorded(self):
+        name = self.image.render_thumbnail(200, 0)
+
+        thumbnail = Thumbnail.objects.get(image=self.image)
+        self.assertEqual((thumbnail.x_size, thumbnail.y_size), (200, 0))
+        self.assertEqual((thumbnail.width, thumbnail.height), (200, 150))
+        self.assertEqual(thumbnail.format, 'JPEG')
+        self.assertEqual(thumbnail.name, name)
+        self.assertEqual(thumbnail.bytes, storage.size(name))
+
+        # existence is checked in the manifest, not in the storage
+        with mock.patch.object(storage, 'exists', side_effect=AssertionError):
+            with self.assertNumQueries(1):
+                self.assertEqual(self.image.render_thumbnail(200, 0), name)
+
+    def test_last_accessed_is_throttled(self):
+        self.image.render_thumbnail(200, 0)
+        Thumbnail.objects.update(
+            last_accessed=timezone.now() - timedelta(days=1))
+
+        with self.assertNumQueries(2):
+            self.image.render_thumbnail(200, 0)
+        with self.assertNumQueries(1):
+            self.image.render_thumbnail(200, 0)
+
+        thumbnail = Thumbnail.objects.get()
+        self.assertGreater(thumbnail.last_accessed,
+                           timezone.now() - timedelta(minutes=1))
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_ACCESS_UPDATE_INTERVAL', 0)
+    def test_access_without_rendering_is_recorded(self):
+        url = '/images/200x0/My Gallery/photo.jpg/'
+        etag = self.client.get(url)['ETag']
+
+        accessed = timezone.now() - timedelta(days=1)
+        for clear_cache, headers in [(False, {}),
+                                     (False, {'HTTP_IF_NONE_MATCH': etag}),
+                                     (True, {'HTTP_IF_NONE_MATCH': etag})]:
+            if clear_cache:
+                thumbnail_cache.clear()
+            Thumbnail.objects.update(last_accessed=accessed)
+
+            self.client.get(url, **headers)
+            self.assertGreater(Thumbnail.objects.get().last_accessed, accessed)
+
+    def test_access_without_rendering_is_throttled(self):
+        url = '/images/200x0/My Gallery/photo.jpg/'
+        etag = self.client.get(url)['ETag']
+
+        # only the image is selected
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        with self.assertNumQueries(1):
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    @mock.patch.object(models, 'RECORDED_ACCESSES_MAX', 2)
+    @mock.patch.object(models, '_recorded_accesses', OrderedDict())
+    def test_oldest_recorded_accesses_are_forgotten(self):
+        now = timezone.now()
+        Thumbnail.remember_accesses({'first': now, 'second': now})
+        Thumbnail.remember_accesses({'first': now})
+        Thumbnail.remember_accesses({'third': now})
+
+        self.assertEqual(list(models._recorded_accesses), ['first', 'third'])
+
+    def test_delete_image_with_thumbnails(self):
+        other = create_image(self.gallery, 'photo2.jpg')
+        name = self.image.render_thumbnail(200, 0)
+        other_name = other.render_thumbnail(200, 0)
+
+        self.image.delete()
+
+        self.assertFalse(storage.exists(name))
+        self.assertTrue(storage.exists(other_name))
+        self.assertEqual(Thumbnail.objects.get().image, other)
+
+    def test_backfill_of_thumbnails_rendered_before_manifest(self):
+        other = create_image(self.gallery, 'photo_1.jpg')
+        name = self.image.render_thumbnail(200, 0)
+        other.render_thumbnail(200, 0)
+
+        # thumbnails rendered before the manifest are not recorded
+        Thumbnail.objects.filter(image=self.image).delete()
+        legacy = self.image.get_thumbnail_name_with_path(100, 0)
+        os.makedirs(os.path.dirname(storage.path(legacy)), exist_ok=True)
+        for legacy_name, size in [(name, (200, 150)), (legacy, (100, 75))]:
+            PILImage.new('RGB', size).save(storage.path(legacy_name), 'JPEG')
+
+        migration = importlib.import_module(
+            'app.gallery.migrations.0014_thumbnail_backfill')
+        migration.backfill_thumbnails(apps, None)
+
+        self.assertEqual(
+            sorted(Thumbnail.objects.values_list('image__path', 'name',
+                                                 'width', 'height')), [
+                ('photo.jpg', legacy, 100, 75),
+                ('photo.jpg', name, 200, 150),
+                ('photo_1.jpg', 'galleries/My%20Gallery/thumbnails/photo_1_200x0.jpg', 200, 150),
+            ])
+
+        self.image.delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(storage.exists(legacy))
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_LOCK_FILES', 2)
+    def test_lock_files_are_bounded(self):
+        names = self.image.render_thumbnails([(300, 0), (200, 0), (100, 0)])
+        evict_thumbnails(quota=0)
+
+        directory = os.path.dirname(storage.path(names[(200, 0)]))
+        self.assertEqual(os.listdir(directory), [])
+        self.assertLessEqual(
+            len(os.listdir(storage.path(app_settings.LOCKS_SUBDIRECTORY))), 2)
+
+
+class ThumbnailLockingTestCase(MediaTestMixin, TransactionTestCase):
+
+    def test_concurrent_renderings(self):
+        image = create_image(Gallery.objects.create(name='My Gallery'))
+        barrier = threading.Barrier(4)
+
+        def render_thumbnails(*args, **kwargs):
+            # let the other threads miss the thumbnail in the manifest
+            time.sleep(0.2)
+            return original_render_thumbnails(*args, **kwargs)
+
+        def render():
+            try:
+                barrier.wait()
+                Image.objects.get(pk=image.pk).render_thumbnail(200, 0)
+            finally:
+                connection.close()
+
+        original_render_thumbnails = rendering.render_thumbnails
+        with mock.patch.object(rendering, 'render_thumbnails',
+                               side_effect=render_thumbnails) as renderer:
+            threads = [threading.Thread(target=render) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(renderer.call_count, 1)
+        self.assertEqual(Thumbnail.objects.count(), 1)
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_RENDER_BACKEND', 'process')
+    @mock.patch.object(app_settings, 'THUMBNAIL_RENDER_TIMEOUT', 0.1)
+    def test_late_rendering_is_recorded(self):
+        image = create_image(Gallery.objects.create(name='My Gallery'))
+        finish = threading.Event()
+
+        def render_thumbnails(*args, **kwargs):
+            finish.wait(10)
+            return original_render_thumbnails(*args, **kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        original_render_thumbnails = rendering.render_thumbnails
+        with mock.patch.object(rendering, 'get_executor', return_value=executor), \
+                mock.patch.object(rendering, 'render_thumbnails',
+                                  side_effect=render_thumbnails) as renderer:
+            response = self.client.get('/images/200x0/My Gallery/image.jpg/')
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(Thumbnail.objects.exists())
+
+            # the next rendering waits for the late one and it's not repeated
+            finish.set()
+            name = Image.objects.get(pk=image.pk).render_thumbnail(200, 0)
+
+        self.assertEqual(renderer.call_count, 1)
+        self.assertEqual(Thumbnail.objects.get().name, name)
+        self.assertTrue(storage.exists(name))
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_RENDER_BACKEND', 'process')
+    @mock.patch.object(app_settings, 'THUMBNAIL_RENDER_TIMEOUT', 0.1)
+    @mock.patch.object(app_settings, 'THUMBNAIL_LOCK_FILES', 1)
+    def test_waiting_for_late_rendering_times_out(self):
+        create_image(Gallery.objects.create(name='My Gallery'))
+        finish = threading.Event()
+
+        def render_thumbnails(*args, **kwargs):
+            finish.wait(10)
+            return original_render_thumbnails(*args, **kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        original_render_thumbnails = rendering.render_thumbnails
+        with mock.patch.object(rendering, 'get_executor', return_value=executor), \
+                mock.patch.object(rendering, 'render_thumbnails',
+                                  side_effect=render_thumbnails):
+            for url in ['/images/200x0/My Gallery/image.jpg/',
+                        '/images/200x0/My Gallery/image.jpg/',
+                        # thumbnail with the same lock file
+                        '/images/100x0/My Gallery/image.jpg/']:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 503)
+
+            # wait for the late rendering
+            finish.set()
+            executor.shutdown()
+            with file_lock(get_thumbnail_lock_path('')):
+                self.assertEqual(Thumbnail.objects.count(), 1)
+
+
+class FileLockTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'test.lock')
+
+    def test_timeout_in_process(self):
+        errors = []
+
+        def acquire():
+            try:
+                with file_lock(self.path, timeout=0.1):
+                    pass
+            except LockTimeout as e:
+                errors.append(e)
+
+        with file_lock(self.path):
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join()
+        self.assertEqual(len(errors), 1)
+
+        # lock is released after timeout
+        acquire()
+        self.assertEqual(len(errors), 1)
+
+    def test_timeout_of_other_process(self):
+        # other open file of the lock file is like the other process
+        with open(self.path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with self.assertRaises(LockTimeout):
+                with file_lock(self.path, timeout=0.1):
+                    pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        with file_lock(self.path, timeout=0.1):
+            pass
+
+
+class LazyExecutorTestCase(SimpleTestCase):
+
+    @mock.patch.object(app_settings, 'UPLOAD_WORKERS', 3)
+    def test_pool(self):
+        lazy = LazyExecutor('UPLOAD_WORKERS', 'gallery-test')
+        executor = lazy.get()
+        self.assertIs(lazy.get(), executor)
+        self.assertEqual(executor._max_workers, 3)
+        self.assertTrue(executor.submit(threading.current_thread).result()
+                        .name.startswith('gallery-test'))
+
+        # the new pool is created after shutdown
+        lazy.shutdown()
+        self.assertIsNot(lazy.get(), executor)
+        lazy.shutdown()
+
+
+class RenderingTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.gallery = Gallery.objects.create(name='My Gallery')
+
+    def test_one_decoding_for_more_thumbnails(self):
+        image = create_image(self.gallery)
+
+        with mock.patch.object(rendering.PILImage, 'open',
+                               wraps=PILImage.open) as open_image:
+            names = image.render_thumbnails([(400, 0), (200, 0), (0, 75)])
+        self.assertEqual(open_image.call_count, 1)
+
+        self.assertEqual(
+            [PILImage.open(storage.path(names[size])).size
+             for size in [(400, 0), (200, 0), (0, 75)]],
+            [(400, 300), (200, 150), (100, 75)])
+
+    def test_big_jpeg_is_decoded_in_draft_size(self):
+        image = create_image(self.gallery, size=(4000, 3000))
+
+        decoded = []
+        draft = JpegImageFile.draft
+
+        def record_draft(jpeg_image, mode, size):
+            result = draft(jpeg_image, mode, size)
+            decoded.append(jpeg_image.size)
+            return result
+
+        with mock.patch.object(JpegImageFile, 'draft', record_draft):
+            name = image.render_thumbnail(200, 0)
+
+        # the smallest DCT scale bigger than the thumbnail is 1/8
+        self.assertEqual(decoded, [(500, 375)])
+        self.assertEqual(PILImage.open(storage.path(name)).size, (200, 150))
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_RENDER_BACKEND', 'process')
+    def test_process_backend(self):
+        image = create_image(self.gallery)
+        name = image.render_thumbnail(200, 0)
+        rendering._executor.shutdown()
+
+        self.assertEqual(PILImage.open(storage.path(name)).size, (200, 150))
+        self.assertEqual(Thumbnail.objects.get().name, name)
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_RENDER_BACKEND', 'process')
+    def test_full_queue(self):
+        create_image(self.gallery)
+
+        with mock.patch.object(rendering, '_queue_slots',
+                               threading.BoundedSemaphore(1)) as slots, \
+                mock.patch.object(rendering, 'get_executor',
+                                  side_effect=AssertionError):
+            slots.acquire()
+            response = self.client.get('/images/200x0/My Gallery/image.jpg/')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(Thumbnail.objects.exists())
+
+
+class ThumbnailEvictionTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+
+        # thumbnails accessed from the oldest to the newest
+        now = timezone.now()
+        self.names = []
+        for i, size in enumerate([(300, 0), (200, 0), (100, 0)]):
+            self.names.append(self.image.render_thumbnail(*size))
+            Thumbnail.objects.filter(x_size=size[0]).update(
+                last_accessed=now - timedelta(days=3 - i))
+
+    def test_least_recently_used_are_evicted(self):
+        sizes = [storage.size(name) for name in self.names]
+
+        count, freed = evict_thumbnails(quota=sizes[2] + sizes[1])
+        self.assertEqual((count, freed), (1, sizes[0]))
+        self.assertFalse(storage.exists(self.names[0]))
+        self.assertTrue(storage.exists(self.names[1]))
+        self.assertTrue(storage.exists(self.image.file.name))
+
+        self.assertEqual(evict_thumbnails(quota=sum(sizes)), (0, 0))
+
+    def test_command(self):
+        output = io.StringIO()
+        call_command('evict_thumbnails', quota=0, stdout=output)
+
+        self.assertIn('Evicted 3 thumbnails', output.getvalue())
+        self.assertFalse(Thumbnail.objects.exists())
+        self.assertTrue(storage.exists(self.image.file.name))
+
+    def test_originals_are_never_deleted(self):
+        Thumbnail.objects.update(name=self.image.file.name)
+        evict_thumbnails(quota=0)
+        self.assertTrue(storage.exists(self.image.file.name))
+
+
+@mock.patch.object(app_settings, 'THUMBNAIL_SIZES', [(200, 200), (400, 400), (0, 300)])
+class SizePolicyTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+
+    def get_names(self):
+        return sorted(Thumbnail.objects.values_list('name', flat=True))
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_SIZE_POLICY', 'allowlist')
+    def test_allowlist(self):
+        response = self.client.get('/images/200x200/My Gallery/image.jpg/')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+        response = self.client.get('/images/201x200/My Gallery/image.jpg/')
+        self.assertIn('non_field_errors', response.json())
+        self.assertEqual(Thumbnail.objects.count(), 1)
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_SIZE_POLICY', 'snap')
+    def test_snap(self):
+        for url in ['/images/199x200/My Gallery/image.jpg/',
+                    '/images/201x210/My Gallery/image.jpg/',
+                    '/images/0x280/My Gallery/image.jpg/']:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.assertEqual(self.get_names(), [
+            'galleries/My%20Gallery/thumbnails/image_0x300.jpg',
+            'galleries/My%20Gallery/thumbnails/image_200x200.jpg',
+        ])
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_SIZE_POLICY', 'redirect')
+    def test_redirect(self):
+        response = self.client.get('/images/390x380/My Gallery/image.jpg/')
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'],
+                         '/images/400x400/My%20Gallery/image.jpg/')
+
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.get_names()), 1)
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_MAX_SIZE', 300)
+    def test_max_size(self):
+        response = self.client.get('/images/301x0/My Gallery/image.jpg/')
+        self.assertIn('non_field_errors', response.json())
+        self.assertFalse(Thumbnail.objects.exists())
+
+
+class FormatNegotiationTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+        self.url = '/images/200x0/My Gallery/image.jpg/'
+
+    def get_format(self, response):
+        return PILImage.open(io.BytesIO(response.content)).format
+
+    def test_webp(self):
+        original = self.client.get(self.url)
+        self.assertEqual(original['Content-Type'], 'image/jpeg')
+        self.assertEqual(original['Vary'], 'Accept')
+
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Vary'], 'Accept')
+        self.assertEqual(self.get_format(response), 'WEBP')
+        self.assertNotEqual(response['ETag'], original['ETag'])
+
+        # each format is a separate variant
+        self.assertEqual(len(thumbnail_cache), 2)
+        self.assertEqual(
+            sorted(Thumbnail.objects.values_list('format', 'name')), [
+                ('JPEG', 'galleries/My%20Gallery/thumbnails/image_200x0.jpg'),
+                ('WEBP', 'galleries/My%20Gallery/thumbnails/image_200x0.webp'),
+            ])
+
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp',
+                                   HTTP_IF_NONE_MATCH=original['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_preference(self):
+        response = self.client.get(
+            self.url, HTTP_ACCEPT='image/avif,image/webp,image/*;q=0.8')
+        self.assertEqual(response['Content-Type'], 'image/avif')
+
+        response = self.client.get(
+            self.url, HTTP_ACCEPT='image/avif;q=0,image/webp')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+
+        response = self.client.get(self.url, HTTP_ACCEPT='image/*')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+    @mock.patch.object(app_settings, 'THUMBNAIL_FORMATS', ())
+    def test_negotiation_disabled(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(Thumbnail.objects.get().format, 'JPEG')
+
+
+class RangeRequestsTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+        with self.image.file.open('rb') as image_file:
+            self.content = image_file.read()
+        self.url = '/gallery/My Gallery/image.jpg'
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'],
+                         'bytes 10-19/{}'.format(len(self.content)))
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[-5:])
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,100-')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(self.content[100:], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=999999-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_ranges_of_empty_file(self):
+        self.assertEqual(parse_range_header('bytes=-5', 0), [])
+        self.assertEqual(parse_range_header('bytes=0-', 0), [])
+        self.assertEqual(parse_range_header('bytes=-5,0-9', 0), [])
+        self.assertEqual(parse_range_header('bytes=-5', 3), [(0, 2)])
+
+    def test_if_range(self):
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9',
+                                   HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+
+class DeliveryBackendTestCase(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+
+    @mock.patch.object(app_settings, 'IMAGE_DELIVERY_BACKEND', 'x-accel-redirect')
+    def test_x_accel_redirect(self):
+        response = self.client.get('/gallery/My Gallery/image.jpg')
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/galleries/My%2520Gallery/image.jpg')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('ETag', response)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get('/images/200x0/My Gallery/image.jpg/')
+        self.assertEqual(
+            response['X-Accel-Redirect'],
+            '/protected/galleries/My%2520Gallery/thumbnails/image_200x0.jpg')
+        self.assertEqual(len(thumbnail_cache), 0)
+
+    @mock.patch.object(app_settings, 'IMAGE_DELIVERY_BACKEND', 'x-sendfile')
+    def test_x_sendfile(self):
+        response = self.client.get('/gallery/My Gallery/image.jpg')
+        self.assertEqual(response['X-Sendfile'], self.image.file.path)
+        self.assertEqual(response.content, b'')
+
+
+class GraphAPIHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for Facebook Graph API `/me` endpoint. Token 'valid' is
+    the only valid token, token 'broken' causes server error.
+    """
+    requests = 0
+
+    def do_GET(self):
+        GraphAPIHandler.requests += 1
+
+        if self.headers['Authorization'] == 'Bearer valid':
+            self._send_json(200, {'id': '42', 'name': 'John Doe'})
+        elif self.headers['Authorization'] == 'Bearer broken':
+            self._send_json(500, {})
+        else:
+            self._send_json(401, {'error': {'type': 'OAuthException'}})
+
+    def _send_json(self, status_code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GraphAPIMixin:
+    """
+    Mixin for test cases with local stand-in for Facebook Graph API.
+    """
+
+    def setUp(self):
+        server = HTTPServer(('127.0.0.1', 0), GraphAPIHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}/me?'.format(server.server_port)
+        patcher = mock.patch.object(app_settings, 'FACEBOOK_GRAPH_API_ME_URL', url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        GraphAPIHandler.requests = 0
+        get_token_cache().clear()
+        self.addCleanup(get_token_cache().clear)
+
+        breaker = mock.patch.object(graph, 'breaker', graph.CircuitBreaker(3, 60))
+        breaker.start()
+        self.addCleanup(breaker.stop)
+
+
+class GraphAPITestCase(GraphAPIMixin, TestCase):
+    pass
+
+
+class TokenCacheTestCase(GraphAPITestCase):
+
+    def test_valid_token_is_cached(self):
+        authentication = SimpleFacebookAuthentication()
+
+        for i in range(3):
+            user, token = authentication.authenticate_credentials('valid')
+            self.assertEqual(user.fb_id, '42')
+            self.assertEqual(user.fb_name, 'John Doe')
+        self.assertEqual(GraphAPIHandler.requests, 1)
+
+        invalidate_token('valid')
+        authentication.authenticate_credentials('valid')
+        self.assertEqual(GraphAPIHandler.requests, 2)
+
+    def test_invalid_token_is_cached(self):
+        authentication = SimpleFacebookAuthentication()
+
+        for i in range(3):
+            with self.assertRaises(exceptions.AuthenticationFailed) as context:
+                authentication.authenticate_credentials('invalid')
+            self.assertIn('redirect_url', context.exception.detail)
+        self.assertEqual(GraphAPIHandler.requests, 1)
+
+    @mock.patch.object(app_settings, 'FACEBOOK_TOKEN_CACHE_NEGATIVE_TTL', 0)
+    def test_negative_ttl(self):
+        authentication = SimpleFacebookAuthentication()
+
+        for i in range(2):
+            with self.assertRaises(exceptions.AuthenticationFailed):
+                authentication.authenticate_credentials('invalid')
+        self.assertEqual(GraphAPIHandler.requests, 2)
+
+
+class GraphClientTestCase(GraphAPITestCase):
+
+    def test_session_is_shared(self):
+        authentication = SimpleFacebookAuthentication()
+        authentication.verify_credentials('valid')
+        session = graph.get_session()
+        authentication.verify_credentials('valid')
+        self.assertIs(graph.get_session(), session)
+
+    @mock.patch.object(app_settings, 'FACEBOOK_GRAPH_RETRIES', 0)
+    @mock.patch.object(graph, '_session', None)
+    def test_circuit_breaker(self):
+        authentication = SimpleFacebookAuthentication()
+
+        for i in range(3):
+            with self.assertRaises(ServiceUnavailable):
+                authentication.authenticate_credentials('broken')
+        self.assertEqual(GraphAPIHandler.requests, 3)
+
+        # circuit is open, API is not called at all
+        with self.assertRaises(ServiceUnavailable):
+            authentication.authenticate_credentials('valid')
+        self.assertEqual(GraphAPIHandler.requests, 3)
+
+        graph.breaker.record_success()
+        user, token = authentication.authenticate_credentials('valid')
+        self.assertEqual(user.fb_id, '42')
+
+
+class ASGIHandlerTestCase(MediaTestMixin, TransactionTestCase):
+    """
+    Views run in the thread pool with their own database connections, so the
+    test data must be committed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.image = create_image(Gallery.objects.create(name='My Gallery'))
+        with self.image.file.open('rb') as image_file:
+            self.content = image_file.read()
+
+    def get(self, path, headers=(), query_string=b''):
+        """
+        Sends GET request through `GalleryASGIHandler`. Returns status code,
+        headers and body of the response.
+        """
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': query_string,
+            'headers': [(b'host', b'testserver')] + list(headers),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(GalleryASGIHandler()(scope, receive, send))
+
+        start = messages[0]
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return start['status'], dict(start['headers']), body
+
+    def test_image_detail(self):
+        status_code, headers, body = self.get('/gallery/My Gallery/image.jpg')
+        self.assertEqual(status_code, 200)
+        self.assertEqual(body, self.content)
+
+    def test_image_range(self):
+        status_code, headers, body = self.get('/gallery/My Gallery/image.jpg',
+                                              [(b'range', b'bytes=5-14')])
+        self.assertEqual(status_code, 206)
+        self.assertEqual(body, self.content[5:15])
+
+    def test_image_preview(self):
+        status_code, headers, body = self.get('/images/200x0/My Gallery/image.jpg/')
+        self.assertEqual(status_code, 200)
+        self.assertEqual(PILImage.open(io.BytesIO(body)).size, (200, 150))
+
+    def test_gallery_detail_stream(self):
+        # images are read from database while the response is sent
+        status_code, headers, body = self.get('/gallery/My Gallery',
+                                              query_string=b'stream=1')
+        self.assertEqual(status_code, 200)
+        self.assertEqual([image['path'] for image in json.loads(body)['images']],
+                         ['image.jpg'])
+
+    def record_signal_threads(self):
+        """
+        Returns dictionary of sets of names of the threads, which send
+        `request_started` and `request_finished` signals.
+        """
+        threads = {request_started: set(), request_finished: set()}
+
+        def receiver(signal, **kwargs):
+            threads[signal].add(threading.current_thread().name)
+
+        for signal in threads:
+            signal.connect(receiver)
+            self.addCleanup(signal.disconnect, receiver)
+        return threads
+
+    def test_request_finished_in_view_thread(self):
+        threads = self.record_signal_threads()
+        status_code, headers, body = self.get('/gallery/My Gallery')
+        self.assertEqual(status_code, 200)
+
+        self.assertEqual(threads[request_started], threads[request_finished])
+        self.assertNotIn(threading.current_thread().name,
+                         threads[request_started])
+
+    def test_files_read_in_shared_pool(self):
+        threads = self.record_signal_threads()
+        self.get('/gallery/My Gallery/image.jpg')
+        self.get('/gallery/My Gallery/image.jpg', [(b'range', b'bytes=5-14')])
+
+        self.assertTrue(threads[request_finished])
+        for name in threads[request_finished]:
+            self.assertTrue(name.startswith('gallery-file'))
+
+
+class UploadTestCase(MediaTestMixin, GraphAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.gallery = Gallery.objects.create(name='My Gallery')
+
+    def upload(self, files):
+        return self.client.post('/gallery/My Gallery', files,
+                                HTTP_AUTHORIZATION='Bearer valid')
+
+    def test_upload(self):
+        response = self.upload({
+            'first': create_image_file('first.jpg', (640, 480)),
+            'second': create_image_file('second.jpg'),
+            'broken': SimpleUploadedFile('broken.jpg', b'not an image'),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([image['path'] for image in response.json()['uploaded']],
+                         ['first-42.jpg', 'second-42.jpg'])
+        self.assertEqual([error['name'] for error in response.json()['errors']],
+                         ['broken-42.jpg'])
+
+        image = Image.objects.get(path='first-42.jpg')
+        self.assertEqual((image.width, image.height), (640, 480))
+
+    def test_dimensions_are_read_only_by_validation(self):
+        with mock.patch('django.core.files.images.get_image_dimensions',
+                        side_effect=AssertionError):
+            response = self.upload({'first': create_image_file('first.jpg')})
+        self.assertEqual(response.status_code, 200)
+
+        image = Image.objects.get(path='first-42.jpg')
+        self.assertEqual((image.width, image.height), (800, 600))
+
+    def test_upload_queries(self):
+        with CaptureQueriesContext(connection) as one_file:
+            self.upload({'first': create_image_file('first.jpg')})
+
+        with CaptureQueriesContext(connection) as more_files:
+            self.upload({
+                'second': create_image_file('second.jpg'),
+                'third': create_image_file('third.jpg'),
+                'fourth': create_image_file('fourth.jpg'),
+            })
+
+        self.assertEqual(len(more_files), len(one_file))
+        self.assertEqual(Image.objects.count(), 4)
+
+    @mock.patch.object(app_settings, 'UPLOAD_MAX_FILES', 1)
+    def test_too_many_files(self):
+        response = self.upload({
+            'first': create_image_file('first.jpg'),
+            'second': create_image_file('second.jpg'),
+        })
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Image.objects.exists())
+
+    @mock.patch.object(app_settings, 'UPLOAD_MAX_BYTES', 1024)
+    def test_too_many_bytes(self):
+        response = self.upload({'first': create_image_file('first.jpg')})
+        self.assertEqual(response.status_code, 413)
+
+
+@mock.patch.object(app_settings, 'THUMBNAIL_PRERENDER_SIZES', [(200, 0), (0, 100)])
+class PrerenderTestCase(MediaTestMixin, GraphAPIMixin, TransactionTestCase):
+    """
+    Thumbnails are rendered in the thread pool after commit, so the test data
+    must be committed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.gallery = Gallery.objects.create(name='My Gallery')
+
+        # futures of the scheduled renderings
+        self.futures = []
+
+        def schedule(image_pk):
+            future = tasks.prerender_thumbnails(image_pk)
+            self.futures.append(future)
+            return future
+
+        for module in (signals, uploads):
+            patcher = mock.patch.object(module, 'prerender_thumbnails',
+                                        side_effect=schedule)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assertPrerendered(self, images):
+        for future in self.futures:
+            future.result(timeout=10)
+
+        self.assertEqual(len(self.futures), len(images))
+        for image in images:
+            self.assertEqual(
+                sorted(Thumbnail.objects.filter(image=image)
+                                        .values_list('x_size', 'y_size')),
+                [(0, 100), (200, 0)])
+            for thumbnail in Thumbnail.objects.filter(image=image):
+                self.assertTrue(storage.exists(thumbnail.name))
+
+    def test_model_save(self):
+        image = create_image(self.gallery)
+        self.assertPrerendered([image])
+
+    def test_upload(self):
+        response = self.client.post('/gallery/My Gallery', {
+            'first': create_image_file('first.jpg'),
+            'second': create_image_file('second.jpg'),
+        }, HTTP_AUTHORIZATION='Bearer valid')
+        self.assertEqual(response.status_code, 200)
+        self.assertPrerendered(Image.objects.all())
+
+
+class ImageWritesTestCase(MediaTestMixin, GraphAPITestCase):
+    """
+    Number of database writes per uploaded image.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.gallery = Gallery.objects.create(name='My Gallery')
+
+    def assertWrites(self, queries, count):
+        writes = [query['sql'] for query in queries
+                  if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), count, writes)
+
+    def test_model_save(self):
+        with CaptureQueriesContext(connection) as queries:
+            image = create_image(self.gallery, 'image.jpg')
+
+        self.assertWrites(queries, 1)
+        image.refresh_from_db()
+        self.assertEqual(image.path, 'image.jpg')
+        self.assertEqual(image.fullpath, 'My%20Gallery/image.jpg')
+
+    def test_admin_form(self):
+        form = ImageForm(data={'gallery': self.gallery.pk},
+                         files={'file': create_image_file('image.jpg')})
+        self.assertTrue(form.is_valid(), form.errors)
+
+        with CaptureQueriesContext(connection) as queries:
+            image = form.save()
+
+        self.assertWrites(queries, 1)
+        self.assertEqual(Image.objects.get(pk=image.pk).path, 'image.jpg')
+
+    def test_api_upload(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/gallery/My Gallery', {
+                'first': create_image_file('first.jpg'),
+                'second': create_image_file('second.jpg'),
+            }, HTTP_AUTHORIZATION='Bearer valid')
+
+        self.assertWrites(queries, 1)
+        self.assertEqual(sorted(Image.objects.values_list('path', flat=True)),
+                         ['first-42.jpg', 'second-42.jpg'])
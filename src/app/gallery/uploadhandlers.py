@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import logging
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadBudgetHandler(FileUploadHandler):
+    """
+    Upload handler, which stops the upload, when request has more than
+    `max_files` files or more than `max_bytes` bytes of files. Then
+    `exceeded` attribute is set.
+
+    It does not store files, data are passed to the next handlers (by default
+    Django keeps small files in memory and streams big files to temporary
+    files).
+    """
+
+    def __init__(self, request=None, max_files=None, max_bytes=None):
+        super().__init__(request)
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.exceeded = False
+        self.files = 0
+        self.bytes = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.files += 1
+
+        if self.max_files is not None and self.files > self.max_files:
+            self._stop('Too many files in upload: {}'.format(self.files))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.bytes += len(raw_data)
+
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            self._stop('Upload exceeded {} bytes'.format(self.max_bytes))
+
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+    def _stop(self, message):
+        logger.warning(message)
+        self.exceeded = True
+        raise StopUpload(connection_reset=False)
@@ -20,7 +20,7 @@ urlpatterns = [
 
     # Image preview (request for thumbnails): GET
     path('images/<int:x_size>x<int:y_size>/<str:gallery_path>/<str:image_path>/',
-         image_preview_view),
+         image_preview_view, name='image-preview'),
 
     # redirect from facebook auth api
     path('token/',
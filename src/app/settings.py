@@ -76,12 +76,50 @@ WSGI_APPLICATION = 'app.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# PostgreSQL is used, when `DATABASE_HOST` environment variable is set,
+# SQLite database in `BASE_DIR` otherwise. Connections are persistent for
+# `DATABASE_CONN_MAX_AGE` seconds, pool them with PgBouncer in front of the
+# PostgreSQL. Read replicas are listed in `DATABASE_REPLICA_HOSTS` (comma
+# separated) and they are used by `GET` views through `ReplicaRouter`.
+
+def get_postgresql_database(host):
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'HOST': host,
+        'PORT': os.environ.get('DATABASE_PORT', ''),
+        'NAME': os.environ.get('DATABASE_NAME', 'gallery'),
+        'USER': os.environ.get('DATABASE_USER', 'gallery'),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
     }
-}
+
+
+if os.environ.get('DATABASE_HOST'):
+    DATABASES = {
+        'default': get_postgresql_database(os.environ['DATABASE_HOST']),
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'OPTIONS': {
+                # seconds to wait for the lock of the database
+                'timeout': 20,
+            },
+        }
+    }
+
+DATABASE_REPLICAS = []
+
+for i, host in enumerate(
+        filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(','))):
+    alias = 'replica_{}'.format(i)
+    DATABASES[alias] = dict(get_postgresql_database(host.strip()),
+                            TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['app.db_routers.ReplicaRouter']
 
 
 # Password validation